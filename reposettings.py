@@ -1,9 +1,23 @@
-from cProfile import label
+import argparse
+import contextvars
+import cProfile
+import gzip
+import io
+import json
+import math
 import os
+import pstats
 import sys
 import re
+import socket
+import sqlite3
+import threading
+import time
 from collections.abc import Container
-from github import Github, Repository, Label, GithubObject
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+from github import Github, Repository, Label, GithubObject, UnknownObjectException
+from github.Requester import Requester
 import yaml
 
 
@@ -20,6 +34,14 @@ class RepoSetter:
     def name() -> str:
         return "Unnamed reposetter"
 
+    @staticmethod
+    def depends_on() -> tuple:
+        """
+        Setter classes that must be done with a repo before this one starts. Setters that do not depend on each other
+        are run concurrently.
+        """
+        return ()
+
     @staticmethod
     def has_changes(new: dict, old) -> bool:
         if len(new) == 0:
@@ -32,7 +54,7 @@ class RepoSetter:
                 old_val = old[k]
             else:
                 try:
-                    old_val = old.__getattribute__(k)
+                    old_val = getattr(old, k)
                 except Exception as e:
                     old_val = None
 
@@ -42,27 +64,160 @@ class RepoSetter:
 
 
 class RepoSettings:
-    def __init__(self, githubclient: Github):
+    # Name of the setter running in the current thread
+    current_setter = contextvars.ContextVar('current_setter', default=None)
+
+    def __init__(self, githubclient: Github, profiler: 'Profiler' = None, workers: int = 1, memo: 'RunMemo' = None):
         self._gh = githubclient
         self._setters = []
+        self._profiler = profiler or Profiler(enabled=False)
+        self._workers = workers
+        self._memo = memo or RunMemo()
+        self._setter_pool = None
+        self._setter_pool_lock = threading.Lock()
 
     def use(self, setter: RepoSetter):
         self._setters.append(setter)
 
+    def close(self):
+        """
+        Stops the threads setters run in, once the run is over.
+        """
+        with self._setter_pool_lock:
+            pool, self._setter_pool = self._setter_pool, None
+        if pool is not None:
+            pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     def apply(self, config: dict):
-        if not self._validate(config):
-            raise Exception("Invalid config supplied")
+        """
+        Applies setters to repos, processing up to `workers` repos at once. The output of each repo is printed as a
+        whole, in config order, once it and the repos before it are done. If a repo fails, repos not yet started are
+        skipped and the first error is raised.
+        """
+        repos = list(self.repos(config))
+        errors = []
+        failed = threading.Event()
+
+        with _thread_output() as stdout, ThreadPoolExecutor(max_workers=self._workers) as pool:
+            futures = [
+                pool.submit(contextvars.copy_context().run, self._apply_repo, name, repoconfig, failed)
+                for name, repoconfig in repos
+            ]
+            for future in futures:  # In config order, so logs read the same whatever the number of workers
+                output, error = future.result()
+                stdout.write(output)
+                if error is not None:
+                    errors.append(error)
+
+        if errors:
+            raise errors[0]
+
+    def apply_repo(self, name: str, repoconfig: dict):
+        """
+        Applies setters to a single repo, returning what they printed and the exception they failed with, if any.
+        """
+        with _thread_output():
+            return self._apply_repo(name, repoconfig)
 
-        for name in config['repos']:
-            repoconfig = config['repos'][name]
-            name = re.sub(r'(https?://)?github\.com/?', '', name)
-            repo = self._gh.get_repo(name)
+    def _apply_repo(self, name: str, repoconfig: dict, failed: threading.Event = None):
+        failed = failed or threading.Event()
+        if failed.is_set():
+            return "", None
+
+        with sys.stdout.capture() as output, self._profiler.cpu():
+            try:
+                with self._profiler.span(f"repo:{name}"):
+                    repo = self._gh.get_repo(name)
+
+                    print(f"Processing repo '{repo.name}'...")
+                    self._apply_setters(repo, repoconfig)
+                    print()
+            except Exception as e:
+                failed.set()
+                return output.getvalue(), e
+        return output.getvalue(), None
 
-            print(f"Processing repo '{repo.name}'...")
-            for setter in self._setters:
+    def _apply_setters(self, repo: Repository, repoconfig: dict):
+        """
+        Runs all setters on a repo, concurrently where their dependencies allow it, and prints their output grouped
+        per setter in the order they were registered.
+        """
+        logs = {}
+        errors = []
+
+        pool = self._get_setter_pool()
+        for stage in self._stages():
+            futures = [
+                # Copy the context so spans opened by the setter nest under the current repo
+                (setter, pool.submit(contextvars.copy_context().run, self._run_setter, setter, repo, repoconfig))
+                for setter in stage
+            ]
+            for setter, future in futures:
+                logs[id(setter)], error = future.result()
+                if error is not None:
+                    errors.append(error)
+            if errors:  # Do not start setters depending on a failed one
+                break
+
+        for setter in self._setters:
+            if id(setter) in logs:
                 print(f"Using setter '{setter.name()}'")
+                print(logs[id(setter)], end='')
+
+        if errors:
+            raise errors[0]
+
+    def _get_setter_pool(self) -> ThreadPoolExecutor:
+        """
+        Returns the pool setters run in. It is shared by all repos so that its threads, and whatever they keep per
+        thread such as their CPU profile, last for the whole run instead of one repo.
+        """
+        with self._setter_pool_lock:
+            if self._setter_pool is None:
+                self._setter_pool = ThreadPoolExecutor(max_workers=self._workers * max(len(self._setters), 1))
+            return self._setter_pool
+
+    def _run_setter(self, setter: RepoSetter, repo: Repository, repoconfig: dict):
+        self.current_setter.set(setter.name())
+        with sys.stdout.capture() as output, self._memo.active(), self._profiler.cpu(), \
+                self._profiler.span(f"setter:{setter.name()}"):
+            try:
                 setter.set(repo, repoconfig)
-            print()
+            except Exception as e:
+                return output.getvalue(), e
+        return output.getvalue(), None
+
+    def _stages(self):
+        """
+        Groups setters in stages, where every setter only depends on setters from previous stages.
+        """
+        pending = list(self._setters)
+        while pending:
+            stage = [setter for setter in pending if not any(
+                isinstance(other, tuple(setter.depends_on())) for other in pending if other is not setter
+            )]
+            if not stage:
+                raise Exception(f"Circular dependency between setters: {', '.join(s.name() for s in pending)}")
+
+            yield stage
+            pending = [setter for setter in pending if setter not in stage]
+
+    @staticmethod
+    def repos(config: dict):
+        """
+        Yields the name and config of every repo in the config, with names normalized to `owner/name`.
+        """
+        if not RepoSettings._validate(config):
+            raise Exception("Invalid config supplied")
+
+        for name in config['repos']:
+            yield re.sub(r'(https?://)?github\.com/?', '', name), config['repos'][name]
 
     @staticmethod
     def _validate(config: dict):
@@ -72,33 +227,660 @@ class RepoSettings:
                and len(config['repos']) > 0
 
 
+COMMANDS = ('apply', 'snapshot', 'plan', 'estimate', 'enqueue', 'work')
+
+
 def main():
-    if len(sys.argv) < 2:
-        print(f"Usage: {sys.argv[0]} <reposettings.yml>")
-        sys.exit(1)
+    profiled = argparse.ArgumentParser(add_help=False)
+    profiled.add_argument('--profile', metavar='PREFIX',
+                          help="Profile the run, writing PREFIX.pstats and PREFIX.collapsed (flamegraph.pl input)")
+    common = argparse.ArgumentParser(add_help=False, parents=[profiled])
+    common.add_argument('config', help="YAML settings file, see reposettings.yml")
+
+    parser = argparse.ArgumentParser(description="Batch-update repo settings")
+    commands = parser.add_subparsers(dest='command', required=True)
+    apply_parser = commands.add_parser('apply', parents=[common], help="Apply settings to repos (default)")
+    apply_parser.add_argument('--workers', type=int, default=8,
+                              help="Repos processed at once. Requests in flight are limited separately and tuned "
+                                   "automatically (default: %(default)s)")
+    apply_parser.add_argument('--batch-writes', type=int, metavar='SIZE', nargs='?', const=50,
+                              help="Send label and repo feature changes as GraphQL mutations once all repos are "
+                                   "processed, SIZE per request (default: %(const)s)")
+    apply_parser.set_defaults(run=apply)
+    snapshot_parser = commands.add_parser('snapshot', parents=[common],
+                                          help="Save the current state of repos to a local file")
+    snapshot_parser.add_argument('-o', '--output', required=True, help="Snapshot file, gzipped if it ends in .gz")
+    snapshot_parser.set_defaults(run=snapshot)
+    plan_parser = commands.add_parser('plan', parents=[common],
+                                      help="Show the changes settings would make, without calling the API")
+    plan_parser.add_argument('--from-snapshot', required=True, metavar='FILE',
+                             help="Snapshot file written by the snapshot command")
+    plan_parser.set_defaults(run=plan)
+    estimate_parser = commands.add_parser('estimate', parents=[common],
+                                          help="Estimate the API calls and time a run would take")
+    estimate_parser.add_argument('--from-snapshot', metavar='FILE',
+                                 help="Snapshot file to estimate from, instead of assuming the state of every repo")
+    estimate_parser.add_argument('--per-page', type=int, default=30,
+                                 help="Items per page when listing branches, labels and issues (default: %(default)s)")
+    estimate_parser.add_argument('--assume-labels', type=int, default=0, metavar='N',
+                                 help="Labels each repo is assumed to have without a snapshot (default: %(default)s)")
+    estimate_parser.add_argument('--assume-open-issues', type=int, default=0, metavar='N',
+                                 help="Open issues each repo is assumed to have without a snapshot, all relabelled "
+                                      "when a label is replaced (default: %(default)s)")
+    estimate_parser.add_argument('--latency', type=float, default=0.3,
+                                 help="Seconds per request (default: %(default)s)")
+    estimate_parser.add_argument('--workers', type=int, default=8,
+                                 help="Repos processed at once by apply (default: %(default)s)")
+    estimate_parser.set_defaults(run=estimate)
+    enqueue_parser = commands.add_parser('enqueue', parents=[common],
+                                         help="Load repos into a queue file for workers to process")
+    enqueue_parser.add_argument('--queue', required=True, metavar='FILE', help="SQLite queue file, created if missing")
+    enqueue_parser.set_defaults(run=enqueue)
+    work_parser = commands.add_parser('work', parents=[profiled],
+                                      help="Apply settings to repos taken from a queue file, until none are left")
+    work_parser.add_argument('--queue', required=True, metavar='FILE', help="SQLite queue file loaded with enqueue")
+    work_parser.add_argument('--lease', type=int, default=600, metavar='SECONDS',
+                             help="Seconds a repo stays assigned to this worker without it reporting progress, after "
+                                  "which it is handed to another worker (default: %(default)s)")
+    work_parser.set_defaults(run=work)
+
+    # `reposettings.py reposettings.yml` predates subcommands and still means apply
+    argv = sys.argv[1:]
+    if not argv or argv[0] not in COMMANDS + ('-h', '--help'):
+        argv.insert(0, 'apply')
+    args = parser.parse_args(argv)
+
+    profiler = Profiler(enabled=args.profile is not None)
+    try:
+        with profiler.cpu():
+            args.run(args, profiler)
+    finally:
+        profiler.report(args.profile)
+
+
+def apply(args, profiler: 'Profiler'):
+    config = load_config(args.config, profiler)
+    throttle = Throttle(profiler=profiler)
+    gh = github_client(profiler, throttle)
+    writer = BatchWriter(gh, args.batch_writes) if args.batch_writes else None
 
     try:
-        config = yaml.safe_load(open(sys.argv[1], 'r'))
+        with repo_settings(writer or gh, profiler, args.workers, RunMemo(gh)) as rs, profiler.span("apply"):
+            rs.apply(config)
     except Exception as e:
-        print(f"Could not load settings from {sys.argv[1]}")
-        sys.exit(2)
+        print(str(e))
+        exit(10)
+    finally:
+        if writer is not None:
+            # Writes queued for repos processed before a failure are still sent
+            with profiler.span("batch-writes"):
+                writer.flush()
+        print(f"Requests in flight settled at {int(throttle.reads.limit)} reads, {int(throttle.writes.limit)} writes")
+        if writer is not None and writer.failed:
+            exit(10)
 
+
+def snapshot(args, profiler: 'Profiler'):
+    config = load_config(args.config, profiler)
+    gh = github_client(profiler)
+
+    try:
+        with profiler.span("snapshot"):
+            snap = Snapshot.capture(gh, [name for name, _ in RepoSettings.repos(config)], profiler)
+        snap.save(args.output)
+    except Exception as e:
+        print(str(e))
+        exit(10)
+
+    peak = peak_memory()
+    print(f"Saved state of {len(snap)} repos to {args.output}" + (f", peak memory {peak:.1f} MiB" if peak else ""))
+
+
+def plan(args, profiler: 'Profiler'):
+    config = load_config(args.config, profiler)
+
+    try:
+        snap = Snapshot.load(args.from_snapshot)
+        with repo_settings(snap, profiler) as rs, profiler.span("plan"):
+            rs.apply(config)
+    except Exception as e:
+        print(str(e))
+        exit(10)
+
+
+def estimate(args, profiler: 'Profiler'):
+    config = load_config(args.config, profiler)
+
+    try:
+        snap = Snapshot.load(args.from_snapshot) if args.from_snapshot else None
+        calls = Estimate(snap, args.per_page, config, args.assume_labels, args.assume_open_issues)
+        # Users and teams are looked up through the estimate, which counts them instead
+        with repo_settings(calls, profiler, memo=RunMemo(calls)) as rs, profiler.span("estimate"), \
+                redirect_stdout(io.StringIO()):
+            rs.apply(config)
+    except Exception as e:
+        print(str(e))
+        exit(10)
+
+    for line in calls.report():
+        print(line)
+
+    reads, writes = calls.totals()
+    limits = Throttle()
+    seconds = reads * args.latency / min(args.workers, limits.reads.maximum) + \
+              writes * args.latency / min(args.workers, limits.writes.maximum)
+    duration = f"{seconds:.0f} seconds" if seconds < 120 else f"{seconds / 60:.0f} minutes"
+    print(f"Estimated time: {duration} with {args.workers} workers and {args.latency}s per request")
+
+    ghtoken = os.environ.get('GITHUB_TOKEN')
+    if not ghtoken:
+        print("Set $GITHUB_TOKEN to compare with the remaining quota")
+        return
+
+    # Checking the rate limit does not count against it
+    core = Github(ghtoken).get_rate_limit().core
+    print(f"Remaining quota: {core.remaining} of {core.limit} calls, resets at {core.reset}")
+    if reads + writes > core.remaining:
+        print(f"Warning: the run needs {reads + writes - core.remaining} calls more than remain. Wait for the reset, or "
+              f"split it in at least {math.ceil((reads + writes) / core.limit)} runs one quota period apart")
+
+
+def enqueue(args, profiler: 'Profiler'):
+    config = load_config(args.config, profiler)
+
+    try:
+        queued = WorkQueue(args.queue).load(RepoSettings.repos(config))
+    except Exception as e:
+        print(str(e))
+        exit(10)
+
+    print(f"Queued {queued} repos in {args.queue}")
+
+
+def work(args, profiler: 'Profiler'):
+    gh = github_client(profiler)
+    queue = WorkQueue(args.queue, args.lease)
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+
+    processed = failed = 0
+    with repo_settings(gh, profiler, memo=RunMemo(gh)) as rs, profiler.span("work"):
+        for name, repoconfig in queue.leases(worker):
+            output, error = rs.apply_repo(name, repoconfig)
+            print(output, end='')
+            if error is not None:
+                print(f"Error processing '{name}': {error}")
+                failed += 1
+            queue.complete(name, worker, output, error)
+            processed += 1
+
+    counts = queue.counts()
+    print(f"Processed {processed} repos, {failed} failed. Queue: " +
+          ", ".join(f"{count} {state}" for state, count in sorted(counts.items())))
+    if failed:
+        exit(10)
+
+
+def load_config(path: str, profiler: 'Profiler'):
+    with profiler.span("load-config"):
+        try:
+            return yaml.safe_load(open(path, 'r'))
+        except Exception as e:
+            print(f"Could not load settings from {path}")
+            sys.exit(2)
+
+
+def github_client(profiler: 'Profiler', throttle: 'Throttle' = None):
     ghtoken = os.environ.get('GITHUB_TOKEN')
     if ghtoken == "":
         print("Could not read $GITHUB_TOKEN")
         sys.exit(3)
 
-    gh = Github(ghtoken)
-    rs = RepoSettings(gh)
+    throttle = throttle or Throttle(profiler=profiler)
+    with profiler.span("client-setup"):
+        # The throttle paces requests, PyGithub's own fixed pacing would cap throughput below it and make its sleeps
+        # look like latency. Keep a connection for every request that may be in flight.
+        gh = Github(
+            ghtoken,
+            pool_size=throttle.reads.maximum + throttle.writes.maximum,
+            seconds_between_requests=None,
+            seconds_between_writes=None,
+        )
+        _share_across_threads(gh)
+        profiler.instrument(gh)
+        throttle.instrument(gh)
+        return gh
+
+
+def repo_settings(gh: Github, profiler: 'Profiler', workers: int = 1, memo: 'RunMemo' = None):
+    rs = RepoSettings(gh, profiler, workers, memo)
     rs.use(RepoHook())
     rs.use(BranchProtectionHook())
     rs.use(LabelHook())
+    return rs
+
+
+class _ThreadOutput(io.TextIOBase):
+    """
+    Replacement for sys.stdout that lets each thread divert what it prints into its own buffer, so setters running at
+    the same time do not interleave their output.
+    """
+
+    def __init__(self, target):
+        self._target = target
+        self._local = threading.local()
+
+    def write(self, s):
+        buffer = getattr(self._local, 'buffer', None)
+        return (buffer if buffer is not None else self._target).write(s)
+
+    def flush(self):
+        self._target.flush()
 
+    @contextmanager
+    def capture(self):
+        self._local.buffer = io.StringIO()
+        try:
+            yield self._local.buffer
+        finally:
+            self._local.buffer = None
+
+
+@contextmanager
+def _thread_output():
+    """
+    Installs a _ThreadOutput as sys.stdout, unless there is one already, and yields the stream it prints to by default.
+    """
+    if isinstance(sys.stdout, _ThreadOutput):
+        yield sys.stdout
+        return
+
+    stdout = sys.stdout
+    sys.stdout = _ThreadOutput(stdout)
     try:
-        rs.apply(config)
-    except Exception as e:
-        print(str(e))
-        exit(10)
+        yield stdout
+    finally:
+        sys.stdout = stdout
+
+
+def _share_across_threads(gh: Github):
+    """
+    PyGithub keeps one connection per client and sends each request in two steps, request() and getresponse(), storing
+    the request on the connection in between. Swap the connection class for one that stores it per thread, so the client
+    can be used by several setters at once.
+    """
+    requester = gh._Github__requester
+    base = requester._Requester__connectionClass
+
+    def per_thread(attr):
+        return property(
+            lambda self: getattr(self._pending, attr),
+            lambda self, value: setattr(self._pending, attr, value),
+        )
+
+    def __init__(self, *args, **kwargs):
+        self._pending = threading.local()
+        base.__init__(self, *args, **kwargs)
+
+    requester._Requester__connectionClass = type(f"ThreadSafe{base.__name__}", (base,), {
+        '__init__': __init__,
+        **{attr: per_thread(attr) for attr in ('verb', 'url', 'input', 'headers')},
+    })
+
+
+def _wrap_requests(gh: Github, wrapper):
+    """
+    Routes every HTTP request made by the client through wrapper(send, verb, url), which must call send() and return
+    its result. Requests PyGithub issues again from within one (redirects, 202 retries) are not wrapped twice.
+    """
+    requester = gh._Github__requester
+    request_raw = requester._Requester__requestRaw
+    local = threading.local()
+
+    def wrapped(cnx, verb, url, headers, input):
+        if getattr(local, 'inside', False):
+            return request_raw(cnx, verb, url, headers, input)
+
+        local.inside = True
+        try:
+            return wrapper(lambda: request_raw(cnx, verb, url, headers, input), verb, url)
+        finally:
+            local.inside = False
+
+    requester._Requester__requestRaw = wrapped
+
+
+class Profiler:
+    """
+    Profiler collects CPU profiles and nested wall-clock spans for a run. Time spent waiting on GitHub is recorded as an
+    `http` span below whichever span issued the request, so it can be told apart from local work.
+    """
+
+    _path = contextvars.ContextVar('span_path', default=())
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._spans = {}  # Span path -> [calls, seconds]
+        self._profiles = []
+        self._threads = threading.local()  # Profile of each thread, and how many cpu() blocks it is in
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def span(self, name: str):
+        if not self.enabled:
+            yield
+            return
+
+        path = self._path.get() + (name,)
+        token = self._path.set(path)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._path.reset(token)
+            self._record(path, time.perf_counter() - start)
+
+    @contextmanager
+    def cpu(self):
+        """
+        Profiles the calling thread. Each thread keeps a single profile for the whole run, which nested blocks share.
+        Python >= 3.12 profiles every thread from a single profiler and refuses to start a second one, in which case the
+        already running profiler covers this thread too.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        local = self._threads
+        depth = getattr(local, 'depth', 0)
+        profile = getattr(local, 'profile', None)
+        if depth == 0:
+            if not hasattr(local, 'profile'):
+                profile = cProfile.Profile()
+                try:
+                    profile.enable()
+                    with self._lock:
+                        self._profiles.append(profile)
+                except ValueError:
+                    profile = None
+                local.profile = profile
+            elif profile is not None:
+                profile.enable()
+
+        local.depth = depth + 1
+        try:
+            yield
+        finally:
+            local.depth = depth
+            if depth == 0 and profile is not None:
+                profile.disable()
+
+    def instrument(self, gh: Github):
+        if not self.enabled:
+            return
+
+        def timed(send, verb, url):
+            start = time.perf_counter()
+            try:
+                return send()
+            finally:
+                self._record(self._path.get() + ("http",), time.perf_counter() - start)
+
+        _wrap_requests(gh, timed)
+
+    def _record(self, path: tuple, seconds: float):
+        with self._lock:
+            span = self._spans.setdefault(path, [0, 0.0])
+            span[0] += 1
+            span[1] += seconds
+
+    def collapsed(self):
+        """
+        Returns spans as collapsed stacks, one `parent;child microseconds` line per span, counting only the time not
+        covered by child spans. Setters of a repo run concurrently, so their total can exceed the repo time.
+        """
+        children = {}
+        for path, (_, seconds) in self._spans.items():
+            children[path[:-1]] = children.get(path[:-1], 0.0) + seconds
+
+        lines = []
+        for path, (_, seconds) in sorted(self._spans.items()):
+            own = max(seconds - children.get(path, 0.0), 0.0)
+            lines.append(f"{';'.join(path)} {round(own * 1e6)}")
+
+        own = max(time.perf_counter() - self._start - children.get((), 0.0), 0.0)
+        lines.append(f"other {round(own * 1e6)}")
+        return lines
+
+    def summary(self):
+        """
+        Returns wall-clock totals per phase, adding up repos and setters of all repos.
+        """
+        phases = {}
+        for path, (calls, seconds) in self._spans.items():
+            key = tuple(re.sub(r'^repo:.*', 'repo:*', part) for part in path)
+            phase = phases.setdefault(key, [0, 0.0])
+            phase[0] += calls
+            phase[1] += seconds
+
+        lines = [f"{'phase':<60} {'calls':>8} {'seconds':>10}"]
+        for path, (calls, seconds) in sorted(phases.items()):
+            lines.append(f"{'  ' * (len(path) - 1) + path[-1]:<60} {calls:>8} {seconds:>10.3f}")
+        return lines
+
+    def report(self, prefix: str):
+        if not self.enabled:
+            return
+
+        print("Wall-clock time per phase:")
+        for line in self.summary():
+            print(f" {line}")
+
+        with open(f"{prefix}.collapsed", 'w') as collapsed:
+            collapsed.writelines(f"{line}\n" for line in self.collapsed())
+
+        if self._profiles:
+            stats = pstats.Stats(*self._profiles, stream=sys.stdout)
+            stats.dump_stats(f"{prefix}.pstats")
+            print("Top functions by own CPU time:")
+            stats.sort_stats(pstats.SortKey.TIME).print_stats(15)
+
+        peak = peak_memory()
+        if peak is not None:
+            print(f"Peak memory: {peak:.1f} MiB")
+
+        print(f"Profile written to {prefix}.pstats and {prefix}.collapsed")
+
+
+def peak_memory():
+    """
+    Returns the peak resident memory of the process in MiB, or None on platforms that do not report it.
+    """
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+class AdaptiveLimit:
+    """
+    AdaptiveLimit caps how many requests may be in flight at once, tuning the cap with AIMD: every healthy response
+    raises it by 1/limit, so it grows by about one per round of requests, while a throttled response or a latency spike
+    halves it.
+    """
+
+    def __init__(self, name: str, initial: int, maximum: int, minimum: int = 1,
+                 spike_factor: float = 4.0, cooldown: float = 1.0):
+        self.name = name
+        self.limit = float(initial)
+        self._minimum = minimum
+        self.maximum = maximum
+        self._spike_factor = spike_factor
+        self._cooldown = cooldown
+        self._in_flight = 0
+        self._latency = None  # Moving average of healthy latencies
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self._in_flight >= int(self.limit):
+                self._cond.wait()
+            self._in_flight += 1
+
+    def release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def observe(self, latency: float, throttled: bool):
+        with self._cond:
+            spike = self._latency is not None and latency > self._latency * self._spike_factor
+            if throttled or spike:
+                # Requests in flight when the limit was cut report the same congestion, only act on the first one
+                now = time.monotonic()
+                if now - self._last_decrease >= self._cooldown:
+                    self._last_decrease = now
+                    self.limit = max(self.limit / 2, self._minimum)
+                return
+
+            self._latency = latency if self._latency is None else 0.9 * self._latency + 0.1 * latency
+            self.limit = min(self.limit + 1 / self.limit, self.maximum)
+            self._cond.notify_all()
+
+
+class Throttle:
+    """
+    Throttle holds every request the client makes until its AdaptiveLimit has room for it, with separate limits for
+    reads and writes, and feeds back each response. A response is deemed throttled if it is a 429 or a rate limit 403.
+    PyGithub retries those itself, which shows up here as a latency spike.
+    """
+
+    def __init__(self, reads: AdaptiveLimit = None, writes: AdaptiveLimit = None, profiler: 'Profiler' = None):
+        self.reads = reads or AdaptiveLimit("reads", initial=4, maximum=32)
+        self.writes = writes or AdaptiveLimit("writes", initial=1, maximum=4)
+        self._profiler = profiler or Profiler(enabled=False)
+
+    def instrument(self, gh: Github):
+        _wrap_requests(gh, self._request)
+
+    def _request(self, send, verb: str, url: str):
+        limit = self.reads if verb in ('GET', 'HEAD') else self.writes
+        with self._profiler.span("throttled"):
+            limit.acquire()
+
+        try:
+            start = time.perf_counter()
+            status, headers, output = send()
+            limit.observe(time.perf_counter() - start, self.throttled(status, output))
+            return status, headers, output
+        finally:
+            limit.release()
+
+    @staticmethod
+    def throttled(status: int, output) -> bool:
+        if status == 429:
+            return True
+        if status != 403:
+            return False
+
+        try:
+            message = json.loads(output).get('message', '')
+        except Exception:
+            return False
+        return Requester.isRateLimitError(message)
+
+
+class RunMemo:
+    """
+    RunMemo keeps results that are the same for every repo in a run, such as settings computed from a config fragment
+    shared through a YAML anchor, or whether a user or team exists. Each is computed once, by whichever setter needs it
+    first, while setters needing it at the same time wait for that result.
+    Existence is only checked when a Github client is given, which plans do not have. Estimates give one counting the
+    lookups instead.
+    """
+
+    _current = contextvars.ContextVar('run_memo', default=None)
+
+    def __init__(self, gh: Github = None):
+        self._gh = gh
+        self._lock = threading.Lock()
+        self._results = {}  # Key -> Future
+
+    @property
+    def can_lookup(self):
+        return self._gh is not None
+
+    @staticmethod
+    def current():
+        """
+        Returns the memo of the run the calling setter is part of, or an empty one if the setter runs on its own.
+        """
+        return RunMemo._current.get() or RunMemo()
+
+    @contextmanager
+    def active(self):
+        token = self._current.set(self)
+        try:
+            yield self
+        finally:
+            self._current.reset(token)
+
+    @staticmethod
+    def key(fragment) -> str:
+        return json.dumps(fragment, sort_keys=True, default=str)
+
+    def get(self, key, compute):
+        with self._lock:
+            result = self._results.get(key)
+            owner = result is None
+            if owner:
+                result = self._results[key] = Future()
+
+        if owner:
+            try:
+                result.set_result(compute())
+            except Exception as e:
+                result.set_exception(e)
+        return result.result()
+
+    def user_exists(self, login: str) -> bool:
+        return self.get(('user', login.lower()), lambda: self._exists(
+            lambda: self._gh.get_user(login), f"user '{login}'",
+        ))
+
+    def team_exists(self, org, slug: str) -> bool:
+        return self.get(('team', org.login.lower(), slug.lower()), lambda: self._exists(
+            lambda: org.get_team_by_slug(slug), f"team '{slug}' in '{org.login}'",
+            # Secret teams, or any team without the read:org scope, are only visible to org owners
+            certain=lambda: self.sees_all_teams(org),
+        ))
+
+    def sees_all_teams(self, org) -> bool:
+        return self.get(('owner', org.login.lower()), lambda: self._is_owner(org))
+
+    def _is_owner(self, org) -> bool:
+        try:
+            return self._gh.get_user().get_organization_membership(org.login).role == 'admin'
+        except Exception:
+            return False
+
+    @staticmethod
+    def _exists(lookup, description: str, certain=lambda: True) -> bool:
+        try:
+            lookup()
+        except UnknownObjectException:
+            if not certain():
+                print(f" Warning: {description} was not found, it may not exist or be hidden from the token")
+                return True
+            print(f" Warning: {description} does not exist, leaving it out of branch protection")
+            return False
+        except Exception:
+            pass  # Let GitHub report it when applying
+        return True
 
 
 class RepoHook(RepoSetter):
@@ -139,6 +921,18 @@ class BranchProtectionHook(RepoSetter):
     BranchProtectionHook handles changing branch protection settings
     """
 
+    # Settings this hook may pass to `edit_protection`, and thus compare with the current protection
+    protection_fields = (
+        'dismiss_stale_reviews', 'required_approving_review_count', 'dismissal_users', 'dismissal_teams',
+        'dismissal_apps', 'users_bypass_pull_request_allowances', 'teams_bypass_pull_request_allowances',
+        'apps_bypass_pull_request_allowances', 'user_push_restrictions', 'team_push_restrictions',
+        'app_push_restrictions', 'enforce_admins', 'block_creations', 'required_linear_history', 'allow_force_pushes',
+        'required_conversation_resolution', 'lock_branch', 'allow_fork_syncing',
+    )
+    # Settings naming users and teams
+    user_fields = ('dismissal_users', 'users_bypass_pull_request_allowances', 'user_push_restrictions')
+    team_fields = ('dismissal_teams', 'teams_bypass_pull_request_allowances', 'team_push_restrictions')
+
     @staticmethod
     def name():
         return "Branch protection settings hook"
@@ -152,71 +946,16 @@ class BranchProtectionHook(RepoSetter):
             return
 
         should_protect_default_branch = config.get('protect-default-branch')
+        memo = RunMemo.current()
 
         for branch in repo.get_branches():
             if not (branch.protected or (should_protect_default_branch and repo.default_branch == branch.name)):
                 continue
 
             rules = BranchProtectionHook.rules_for(branch.name, config)
-
-            newsettings = {}
-            # Historically dismiss has been misspelled as "dissmiss". To avoid breaking config, we read that too and
-            # print a warning.
-            if 'dissmiss-stale-reviews' in rules:
-                print(" Warning: using deprecated 'dissmiss-stale-reviews', please replace it with 'dismiss-stale-reviews'")
-                newsettings['dismiss_stale_reviews'] = bool(rules['dissmiss-stale-reviews'])
-            if 'dismiss-stale-reviews' in rules:
-                newsettings['dismiss_stale_reviews'] = bool(rules['dismiss-stale-reviews'])
-            if 'required-review-count' in rules:
-                newsettings['required_approving_review_count'] = int(rules['required-review-count'])
-
-            if 'required-pull-request-reviews' in rules:
-                if 'dismissal-restrictions' in rules["required-pull-request-reviews"]:
-                    dismissal_restrictions = rules["required-pull-request-reviews"]["dismissal-restrictions"]
-                    # PyGithub uses the parameter `dismissal_users`
-                    # GitHub API uses `required_pull_request_reviews.dismissal_restrictions.users`
-                    # Same for teams and apps.
-                    if 'users' in dismissal_restrictions:
-                        newsettings['dismissal_users'] = dismissal_restrictions['users']
-                    if 'teams' in dismissal_restrictions:
-                        newsettings['dismissal_teams'] = dismissal_restrictions['teams']
-                    if 'apps' in dismissal_restrictions:
-                        newsettings['dismissal_apps'] = dismissal_restrictions['apps']
-                if 'bypass-pull-request-allowances' in rules["required-pull-request-reviews"]:
-                    bypass_pull_request_allowances = rules["required-pull-request-reviews"]["bypass-pull-request-allowances"]
-                    # PyGithub uses the parameter `users_bypass_pull_request_allowances`
-                    # GitHub API uses `required_pull_request_reviews.bypass_pull_request_allowances.users`
-                    # Same for teams and apps.
-                    if 'users' in bypass_pull_request_allowances:
-                        newsettings['users_bypass_pull_request_allowances'] = bypass_pull_request_allowances['users']
-                    if 'teams' in bypass_pull_request_allowances:
-                        newsettings['teams_bypass_pull_request_allowances'] = bypass_pull_request_allowances['teams']
-                    if 'apps' in bypass_pull_request_allowances:
-                        newsettings['apps_bypass_pull_request_allowances'] = bypass_pull_request_allowances['apps']
-            if 'push-restrictions' in rules:
-                # PyGithub uses the parameter `user_push_restrictions`
-                # GitHub API uses `push_restrictions.users`
-                # Same for teams and apps.
-                if 'users' in rules['push-restrictions']:
-                    newsettings['user_push_restrictions'] = rules['push-restrictions']['users']
-                if 'teams' in rules['push-restrictions']:
-                    newsettings['team_push_restrictions'] = rules['push-restrictions']['teams']
-                if 'apps' in rules['push-restrictions']:
-                    newsettings['app_push_restrictions'] = rules['push-restrictions']['apps']
-            if 'enforce-admins' in rules:
-                newsettings['enforce_admins'] = bool(rules['enforce-admins'])
-            if 'block-creations' in rules:
-                newsettings['block_creations'] = bool(rules['block-creations'])
-            if 'required-linear-history' in rules:
-                newsettings['required_linear_history'] = bool(rules['required-linear-history'])
-            if 'allow-force-pushes' in rules:
-                newsettings['allow_force_pushes'] = bool(rules['allow-force-pushes'])
-            if 'required-conversation-resolution' in rules:
-                newsettings['required_conversation_resolution'] = bool(rules['required-conversation-resolution'])
-            if 'lock-branch' in rules:
-                newsettings['lock_branch'] = bool(rules['lock-branch'])
-            if 'allow-fork-syncing' in rules:
-                newsettings['allow_fork_syncing'] = bool(rules['allow-fork-syncing'])
+            newsettings = memo.get(('protection-settings', RunMemo.key(rules)),
+                                   lambda: BranchProtectionHook.settings_for(rules))
+            newsettings = BranchProtectionHook.valid_references(repo, newsettings, memo)
 
             # If branch is not protected we cannot get current protection settings, so we cannot call has_changes and must apply changes blindly
             if branch.protected:
@@ -227,6 +966,103 @@ class BranchProtectionHook(RepoSetter):
             print(f" Applying branch protection settings to '{branch.name}'...")
             branch.edit_protection(**newsettings)
 
+    @staticmethod
+    def settings_for(rules: dict):
+        """
+        Translates branch protection rules from the config into `edit_protection` arguments.
+        """
+        newsettings = {}
+        # Historically dismiss has been misspelled as "dissmiss". To avoid breaking config, we read that too and
+        # print a warning.
+        if 'dissmiss-stale-reviews' in rules:
+            print(" Warning: using deprecated 'dissmiss-stale-reviews', please replace it with 'dismiss-stale-reviews'")
+            newsettings['dismiss_stale_reviews'] = bool(rules['dissmiss-stale-reviews'])
+        if 'dismiss-stale-reviews' in rules:
+            newsettings['dismiss_stale_reviews'] = bool(rules['dismiss-stale-reviews'])
+        if 'required-review-count' in rules:
+            newsettings['required_approving_review_count'] = int(rules['required-review-count'])
+
+        if 'required-pull-request-reviews' in rules:
+            if 'dismissal-restrictions' in rules["required-pull-request-reviews"]:
+                dismissal_restrictions = rules["required-pull-request-reviews"]["dismissal-restrictions"]
+                # PyGithub uses the parameter `dismissal_users`
+                # GitHub API uses `required_pull_request_reviews.dismissal_restrictions.users`
+                # Same for teams and apps.
+                if 'users' in dismissal_restrictions:
+                    newsettings['dismissal_users'] = dismissal_restrictions['users']
+                if 'teams' in dismissal_restrictions:
+                    newsettings['dismissal_teams'] = dismissal_restrictions['teams']
+                if 'apps' in dismissal_restrictions:
+                    newsettings['dismissal_apps'] = dismissal_restrictions['apps']
+            if 'bypass-pull-request-allowances' in rules["required-pull-request-reviews"]:
+                bypass_pull_request_allowances = rules["required-pull-request-reviews"]["bypass-pull-request-allowances"]
+                # PyGithub uses the parameter `users_bypass_pull_request_allowances`
+                # GitHub API uses `required_pull_request_reviews.bypass_pull_request_allowances.users`
+                # Same for teams and apps.
+                if 'users' in bypass_pull_request_allowances:
+                    newsettings['users_bypass_pull_request_allowances'] = bypass_pull_request_allowances['users']
+                if 'teams' in bypass_pull_request_allowances:
+                    newsettings['teams_bypass_pull_request_allowances'] = bypass_pull_request_allowances['teams']
+                if 'apps' in bypass_pull_request_allowances:
+                    newsettings['apps_bypass_pull_request_allowances'] = bypass_pull_request_allowances['apps']
+        if 'push-restrictions' in rules:
+            # PyGithub uses the parameter `user_push_restrictions`
+            # GitHub API uses `push_restrictions.users`
+            # Same for teams and apps.
+            if 'users' in rules['push-restrictions']:
+                newsettings['user_push_restrictions'] = rules['push-restrictions']['users']
+            if 'teams' in rules['push-restrictions']:
+                newsettings['team_push_restrictions'] = rules['push-restrictions']['teams']
+            if 'apps' in rules['push-restrictions']:
+                newsettings['app_push_restrictions'] = rules['push-restrictions']['apps']
+        if 'enforce-admins' in rules:
+            newsettings['enforce_admins'] = bool(rules['enforce-admins'])
+        if 'block-creations' in rules:
+            newsettings['block_creations'] = bool(rules['block-creations'])
+        if 'required-linear-history' in rules:
+            newsettings['required_linear_history'] = bool(rules['required-linear-history'])
+        if 'allow-force-pushes' in rules:
+            newsettings['allow_force_pushes'] = bool(rules['allow-force-pushes'])
+        if 'required-conversation-resolution' in rules:
+            newsettings['required_conversation_resolution'] = bool(rules['required-conversation-resolution'])
+        if 'lock-branch' in rules:
+            newsettings['lock_branch'] = bool(rules['lock-branch'])
+        if 'allow-fork-syncing' in rules:
+            newsettings['allow_fork_syncing'] = bool(rules['allow-fork-syncing'])
+
+        return newsettings
+
+    @staticmethod
+    def valid_references(repo: Repository.Repository, settings: dict, memo: 'RunMemo'):
+        """
+        Leaves users and teams that do not exist out of the settings, as GitHub would reject the whole protection.
+        A list is never emptied that way, as an empty list of users allowed to push or dismiss reviews means nobody.
+        """
+        if not memo.can_lookup:
+            return settings
+
+        valid = dict(settings)
+        for field in BranchProtectionHook.user_fields:
+            if field in valid:
+                valid[field] = BranchProtectionHook._existing(field, valid[field], memo.user_exists)
+
+        org = repo.organization
+        if org is not None:  # Repos owned by users cannot have team restrictions anyway
+            for field in BranchProtectionHook.team_fields:
+                if field in valid:
+                    valid[field] = BranchProtectionHook._existing(
+                        field, valid[field], lambda team: memo.team_exists(org, team),
+                    )
+
+        return valid
+
+    @staticmethod
+    def _existing(field: str, names: list, exists) -> list:
+        existing = [name for name in names if exists(name)]
+        if names and not existing:
+            raise Exception(f"None of {', '.join(names)} in '{field}' exist, refusing to set it to nobody")
+        return existing
+
     @staticmethod
     def rules_for(branch_name: str, config):
         if 'branch-protection-overrides' in config:
@@ -249,6 +1085,11 @@ class LabelHook(RepoSetter):
     def name():
         return "Repo labels settings hook"
 
+    @staticmethod
+    def depends_on():
+        # Relabelling issues needs them enabled, which RepoHook may be doing
+        return RepoHook,
+
     @staticmethod
     def set(repo: Repository, config):
         print(" Processing labels...")
@@ -355,5 +1196,713 @@ class LabelHook(RepoSetter):
         LabelHook.delete_label(previous_label)
 
 
+class Snapshot:
+    """
+    Snapshot holds the state setters read from a set of repos: repo settings, branches and their protection, and
+    labels. It can be saved to a file and passed to RepoSettings in place of a Github client to plan changes without
+    calling the API.
+    State is kept as RepoState, BranchState and LabelState records rather than PyGithub objects, which also carry their
+    raw JSON, headers and requester, so that large orgs fit in memory.
+    """
+
+    version = 2
+
+    def __init__(self, repos: dict):
+        self._repos = repos  # Full name -> RepoState
+
+    def __len__(self):
+        return len(self._repos)
+
+    def get_repo(self, name: str):
+        if name not in self._repos:
+            raise Exception(f"Repo '{name}' is not in the snapshot, take a new one")
+        return self._repos[name]
+
+    @staticmethod
+    def capture(gh: Github, names: list, profiler: 'Profiler' = None):
+        profiler = profiler or Profiler(enabled=False)
+        repos = {}
+        for name in names:
+            with profiler.span(f"repo:{name}"):
+                print(f"Reading repo '{name}'...")
+                repos[name] = RepoState.read(gh.get_repo(name))
+        return Snapshot(repos)
+
+    def save(self, path: str):
+        with (gzip.open if path.endswith('.gz') else open)(path, 'wt') as f:
+            json.dump({
+                'version': self.version,
+                'repos': {name: repo.dump() for name, repo in self._repos.items()},
+            }, f, separators=(',', ':'))
+
+    @staticmethod
+    def load(path: str):
+        try:
+            with (gzip.open if path.endswith('.gz') else open)(path, 'rt') as f:
+                data = json.load(f)
+        except Exception as e:
+            raise Exception(f"Could not load snapshot from {path}: {e}")
+
+        if data.get('version') != Snapshot.version:
+            raise Exception(f"Unsupported snapshot version {data.get('version')} in {path}, take a new one")
+        return Snapshot({name: RepoState.load(name, repo) for name, repo in data['repos'].items()})
+
+
+def _describe(**kwargs):
+    return ", ".join(f"{k}={v!r}" for k, v in kwargs.items() if v is not GithubObject.NotSet)
+
+
+class RepoState:
+    """
+    RepoState holds the repo settings setters compare. Within a snapshot it stands in for a Repository, printing the
+    changes setters make instead of applying them.
+    Settings a repo does not have are left unset, so reading them fails as it does on a Repository.
+    """
+
+    settings = (
+        'allow_auto_merge', 'allow_forking', 'allow_merge_commit', 'allow_rebase_merge', 'allow_squash_merge',
+        'allow_update_branch', 'delete_branch_on_merge', 'has_downloads', 'has_issues', 'has_pages', 'has_projects',
+        'has_wiki',
+    )
+    __slots__ = ('full_name', 'name', 'default_branch', 'open_issues_count', 'branches', 'labels') + settings
+
+    @staticmethod
+    def read(repo: Repository.Repository):
+        state = RepoState()
+        state.full_name = repo.full_name
+        state.name = repo.name
+        state.default_branch = repo.default_branch
+        state.open_issues_count = repo.open_issues_count
+        for setting in RepoState.settings:
+            value = getattr(repo, setting)
+            if value is not None:
+                setattr(state, setting, value)
+
+        state.branches = [BranchState.read(branch) for branch in repo.get_branches()]
+        state.labels = [LabelState(l.name, l.color, l.description) for l in repo.get_labels()]
+        return state
+
+    @staticmethod
+    def assumed(full_name: str, labels: list = (), open_issues_count: int = 0):
+        """
+        Returns the state of a repo with one protected default branch, the given labels and nothing else, for when the
+        actual state is unknown.
+        """
+        state = RepoState()
+        state.full_name = full_name
+        state.name = full_name.split('/')[-1]
+        state.default_branch = 'main'
+        state.open_issues_count = open_issues_count
+        state.branches = [BranchState('main', True, ProtectionState())]
+        state.labels = [LabelState(name, None, None) for name in labels]
+        return state
+
+    def dump(self):
+        return {
+            'name': self.name,
+            'default_branch': self.default_branch,
+            'open_issues_count': self.open_issues_count,
+            'settings': {s: getattr(self, s) for s in self.settings if hasattr(self, s)},
+            'branches': [branch.dump() for branch in self.branches],
+            'labels': [[l.name, l.color, l.description] for l in self.labels],
+        }
+
+    @staticmethod
+    def load(full_name: str, data: dict):
+        state = RepoState()
+        state.full_name = full_name
+        state.name = data['name']
+        state.default_branch = data['default_branch']
+        state.open_issues_count = data['open_issues_count']
+        for setting, value in data['settings'].items():
+            setattr(state, setting, value)
+
+        state.branches = [BranchState.load(branch) for branch in data['branches']]
+        state.labels = [LabelState(*label) for label in data['labels']]
+        return state
+
+    def edit(self, **kwargs):
+        print(f" Plan: edit repo settings: {_describe(**kwargs)}")
+
+    def get_branches(self):
+        return self.branches
+
+    def get_labels(self):
+        return self.labels
+
+    def create_label(self, name, color=GithubObject.NotSet, description=GithubObject.NotSet):
+        print(f" Plan: create label '{name}': {_describe(color=color, description=description)}")
+
+    @property
+    def organization(self):
+        # Whether the owner is an org is not part of the snapshot, assume it is so team lookups are counted
+        return OrganizationState(self.full_name.split('/')[0])
+
+    def get_issues(self, labels=GithubObject.NotSet):
+        # Issues are not part of the snapshot
+        for label in labels:
+            print(f" Plan: add the replacement label to issues labeled '{label.name}'")
+        return []
+
+
+class Estimate:
+    """
+    Estimate can be passed to RepoSettings in place of a Github client to count the API calls setters would make,
+    without making any. Repos come from a snapshot if one is given. Otherwise each repo is assumed to have one protected
+    default branch and settings all different from the config, with `labels` labels and `open_issues` open issues,
+    none by default. Those assumed labels are first the ones the repo config replaces, alongside their replacement so
+    that issues get relabelled, then labels the config does not know and deletes. As repos can have more of either, the
+    estimate of a repo without a snapshot is only a lower bound.
+    Listing costs one read per page. Relabelling issues is costed as if all open issues had the replaced label. Users
+    and teams named in branch protection cost a read each per run when Estimate is also the client of the RunMemo.
+    """
+
+    # Repo the calling setter is processing
+    _repo = contextvars.ContextVar('estimate_repo', default=None)
+
+    def __init__(self, snapshot: Snapshot = None, per_page: int = 30, config: dict = None, labels: int = 0,
+                 open_issues: int = 0):
+        self._snapshot = snapshot
+        self._per_page = per_page
+        self._configs = dict(RepoSettings.repos(config)) if config is not None else {}
+        self._labels = labels
+        self._open_issues = open_issues
+        self._lock = threading.Lock()
+        self.calls = {}  # (repo, setter) -> [reads, writes]
+
+    def get_repo(self, name: str):
+        self.count(name, reads=1)
+        self._repo.set(name)
+        if self._snapshot is not None:
+            repo = self._snapshot.get_repo(name)
+        else:
+            repo = RepoState.assumed(name, self.assumed_labels(name), self._open_issues)
+        return _Counted(repo, self, name)
+
+    def get_user(self, login: str = None):
+        # Looked up by RunMemo, once per run, for the repo that needed it first. Users are assumed to exist.
+        self.count(self._repo.get(), reads=1)
+
+    def assumed_labels(self, name: str):
+        """
+        Returns the names of the labels a repo is assumed to have without a snapshot.
+        """
+        labels = []
+        for newname, settings in self._configs.get(name, {}).get('labels', {}).items():
+            for replaced in settings.get('replaces', []):
+                labels += [label for label in (newname, replaced) if label not in labels]
+        labels += [f"unknown label {i}" for i in range(self._labels)]
+        return labels[:self._labels]
+
+    def pages(self, items: int):
+        return max(math.ceil(items / self._per_page), 1)
+
+    def count(self, repo: str, reads: int = 0, writes: int = 0):
+        with self._lock:
+            calls = self.calls.setdefault((repo, RepoSettings.current_setter.get()), [0, 0])
+            calls[0] += reads
+            calls[1] += writes
+
+    def totals(self):
+        return sum(reads for reads, _ in self.calls.values()), sum(writes for _, writes in self.calls.values())
+
+    def report(self):
+        lines = [f"{'repo':<40} {'setter':<35} {'reads':>8} {'writes':>8}"]
+        setters = {}
+        for (repo, setter), (reads, writes) in self.calls.items():
+            setter = setter or "(read repo)"
+            lines.append(f"{repo:<40} {setter:<35} {reads:>8} {writes:>8}")
+            totals = setters.setdefault(setter, [0, 0])
+            totals[0] += reads
+            totals[1] += writes
+
+        for setter, (reads, writes) in setters.items():
+            lines.append(f"{'all repos':<40} {setter:<35} {reads:>8} {writes:>8}")
+        reads, writes = self.totals()
+        lines.append(f"{'total':<76} {reads:>8} {writes:>8}")
+        return lines
+
+
+class _Counted:
+    """
+    Wraps snapshot records, counting the calls the PyGithub method setters call on them would make.
+    """
+
+    # Method -> (reads, writes), given the estimate, the wrapped record and what the method returned
+    costs = {
+        'get_branches': lambda estimate, repo, result: (estimate.pages(len(result)), 0),
+        'get_labels': lambda estimate, repo, result: (estimate.pages(len(result)), 0),
+        'get_protection': lambda estimate, branch, result: (1, 0),
+        'get_issues': lambda estimate, repo, result: (estimate.pages(repo.open_issues_count), repo.open_issues_count),
+        'edit': lambda estimate, obj, result: (0, 1),
+        'edit_protection': lambda estimate, branch, result: (0, 1),
+        'create_label': lambda estimate, repo, result: (0, 1),
+        'delete': lambda estimate, label, result: (0, 1),
+        'get_team_by_slug': lambda estimate, org, result: (1, 0),
+    }
+
+    # Attributes holding records whose methods are counted too
+    records = ('organization',)
+
+    def __init__(self, obj, estimate: Estimate, repo: str):
+        self._obj = obj
+        self._estimate = estimate
+        self._repo = repo
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if name in self.records:
+            return _Counted(attr, self._estimate, self._repo)
+        if name not in self.costs:
+            return attr
+
+        def counted(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            reads, writes = self.costs[name](self._estimate, self._obj, result)
+            self._estimate.count(self._repo, reads, writes)
+            if isinstance(result, list):
+                return [_Counted(item, self._estimate, self._repo) for item in result]
+            if result is not None:
+                return _Counted(result, self._estimate, self._repo)
+            return result
+
+        return counted
+
+
+class BranchState:
+    __slots__ = ('name', 'protected', 'protection')
+
+    def __init__(self, name: str, protected: bool, protection: 'ProtectionState' = None):
+        self.name = name
+        self.protected = protected
+        self.protection = protection
+
+    @staticmethod
+    def read(branch):
+        # Protection can only be read, and is only compared, for protected branches
+        protection = ProtectionState.read(branch.get_protection()) if branch.protected else None
+        return BranchState(branch.name, branch.protected, protection)
+
+    def dump(self):
+        return [self.name, self.protected, self.protection.dump() if self.protection else None]
+
+    @staticmethod
+    def load(data: list):
+        name, protected, protection = data
+        return BranchState(name, protected, ProtectionState.load(protection) if protection is not None else None)
+
+    def get_protection(self):
+        return self.protection or ProtectionState()
+
+    def edit_protection(self, **kwargs):
+        print(f" Plan: edit protection of branch '{self.name}': {_describe(**kwargs)}")
+
+
+class ProtectionState:
+    """
+    ProtectionState holds what RepoSetter.has_changes can read from a BranchProtection for the settings
+    BranchProtectionHook sets. Most of them are not BranchProtection attributes, and are left unset.
+    """
+
+    __slots__ = BranchProtectionHook.protection_fields
+
+    @staticmethod
+    def read(protection):
+        state = ProtectionState()
+        for field in ProtectionState.__slots__:
+            try:
+                value = protection.__getattribute__(field)
+            except Exception:
+                continue
+            if value is None or isinstance(value, (bool, int, str)):
+                setattr(state, field, value)
+        return state
+
+    def dump(self):
+        return {field: getattr(self, field) for field in self.__slots__ if hasattr(self, field)}
+
+    @staticmethod
+    def load(data: dict):
+        state = ProtectionState()
+        for field, value in data.items():
+            setattr(state, field, value)
+        return state
+
+
+class LabelState:
+    __slots__ = ('name', 'color', 'description')
+
+    def __init__(self, name: str, color: str, description: str):
+        self.name = name
+        self.color = color
+        self.description = description
+
+    def edit(self, name, color, description=GithubObject.NotSet):
+        print(f" Plan: edit label '{self.name}': {_describe(name=name, color=color, description=description)}")
+
+    def delete(self):
+        print(f" Plan: delete label '{self.name}'")
+
+
+class OrganizationState:
+    __slots__ = ('login',)
+
+    def __init__(self, login: str):
+        self.login = login
+
+    def get_team_by_slug(self, slug: str):
+        return None  # Teams are assumed to exist
+
+
+class BatchWriter:
+    """
+    BatchWriter can be passed to RepoSettings in place of a Github client. Repos it returns hold back the writes setters
+    make and send them later as aliased GraphQL mutations, many per request, when flush() is called.
+    Only repo features and labels have GraphQL mutations; other writes, such as merge settings or branch protection,
+    still go through the REST API straight away. Label writes that cannot be expressed as a mutation are queued as REST
+    calls instead, so that writes to a repo happen in the order setters made them.
+    """
+
+    # PyGithub repo.edit() arguments and their UpdateRepositoryInput counterpart
+    repo_fields = {
+        'has_issues': 'hasIssuesEnabled',
+        'has_projects': 'hasProjectsEnabled',
+        'has_wiki': 'hasWikiEnabled',
+        'has_discussions': 'hasDiscussionsEnabled',
+    }
+
+    def __init__(self, gh: Github, batch_size: int = 50):
+        self._gh = gh
+        self._batch_size = batch_size
+        self._pending = []
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.failed = 0
+
+    def get_repo(self, name: str):
+        return _BatchedRepo(self._gh.get_repo(name), self)
+
+    def queue(self, repo, description: str, mutation: str = None, input: dict = None, fallback=None):
+        """
+        Queues either a GraphQL mutation with its input, or a fallback function calling the REST API.
+        """
+        write = _PendingWrite(repo.full_name, RepoSettings.current_setter.get(), description, mutation, input, fallback)
+        with self._lock:
+            self._pending.append(write)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+
+        print(f"Sending {len(pending)} pending writes...")
+        batch = []
+        for write in pending:
+            if write.mutation is None:
+                self._send(batch)
+                batch = []
+                try:
+                    write.fallback()
+                except Exception as e:
+                    self._failed(write, e)
+                continue
+
+            batch.append(write)
+            if len(batch) >= self._batch_size:
+                self._send(batch)
+                batch = []
+        self._send(batch)
+
+        print(f"Sent {len(pending)} writes in {self.requests} GraphQL requests, {self.failed} failed")
+
+    def _send(self, batch: list):
+        if not batch:
+            return
+
+        aliases = {f"w{i}": write for i, write in enumerate(batch)}
+        variables = ", ".join(f"${alias}: {self._title(write.mutation)}Input!" for alias, write in aliases.items())
+        fields = " ".join(
+            f"{alias}: {write.mutation}(input: ${alias}) {{ clientMutationId }}" for alias, write in aliases.items()
+        )
+
+        self.requests += 1
+        requester = self._gh._Github__requester
+        try:
+            _, data = requester.requestJsonAndCheck(
+                "POST",
+                requester.graphql_url,
+                # Label mutations were in preview before going stable, and still are on some GitHub Enterprise Servers
+                headers={"Accept": "application/vnd.github.bane-preview+json"},
+                input={
+                    'query': f"mutation({variables}) {{ {fields} }}",
+                    'variables': {alias: write.input for alias, write in aliases.items()},
+                },
+            )
+        except Exception as e:
+            for write in batch:
+                self._failed(write, e)
+            return
+
+        # Mutations in a document run one after the other, and an error only affects its own alias. Without data, or
+        # with an error not tied to an alias, the document as a whole was rejected and none of its mutations ran.
+        errors = data.get('errors') or []
+        rejected = [error for error in errors if (error.get('path') or [None])[0] not in aliases]
+        if data.get('data') is None or rejected:
+            message = "; ".join(str(error.get('message')) for error in rejected or errors) or "no data returned"
+            for write in batch:
+                self._failed(write, message)
+            return
+
+        for error in errors:
+            self._failed(aliases[error['path'][0]], error.get('message'))
+
+    def _failed(self, write: '_PendingWrite', error):
+        print(f" Error in '{write.repo}' ({write.setter}) trying to {write.description}: {error}")
+        self.failed += 1
+
+    @staticmethod
+    def _title(mutation: str):
+        return mutation[:1].upper() + mutation[1:]
+
+
+class _PendingWrite:
+    def __init__(self, repo: str, setter: str, description: str, mutation: str, input: dict, fallback):
+        self.repo = repo
+        self.setter = setter
+        self.description = description
+        self.mutation = mutation
+        self.input = input
+        self.fallback = fallback
+
+
+def _node_id(obj):
+    # Reading raw_data would fetch the whole object again if it came from a list
+    return obj._rawData.get('node_id')
+
+
+class _BatchedRepo:
+    """
+    Wraps a Repository so that writes made through it and the labels and issues it returns are queued in a BatchWriter.
+    """
+
+    def __init__(self, repo: Repository.Repository, writer: BatchWriter):
+        self._repo = repo
+        self.writer = writer
+        self.label_ids = {}  # Label name -> node ID, following renames
+
+    def __getattr__(self, name):
+        return getattr(self._repo, name)
+
+    def edit(self, **kwargs):
+        # Setters in later stages, such as LabelHook relabelling issues, rely on issues being enabled straight away
+        if kwargs.get('has_issues') or not all(k in BatchWriter.repo_fields for k in kwargs):
+            self._repo.edit(**kwargs)
+            return
+
+        input = {BatchWriter.repo_fields[k]: v for k, v in kwargs.items()}
+        input['repositoryId'] = _node_id(self._repo)
+        self.writer.queue(self, "edit repo settings", 'updateRepository', input)
+
+    def get_labels(self):
+        for label in self._repo.get_labels():
+            self.label_ids[label.name] = _node_id(label)
+            yield _BatchedLabel(label, self)
+
+    def create_label(self, name: str, color=GithubObject.NotSet, description=GithubObject.NotSet):
+        if not isinstance(color, str):  # Required by createLabel, let the REST API report it
+            self.writer.queue(self, f"create label '{name}'", fallback=lambda: self._repo.create_label(
+                name=name, color=color, description=description,
+            ))
+            return
+
+        input = {'repositoryId': _node_id(self._repo), 'name': name, 'color': color}
+        if isinstance(description, str):
+            input['description'] = description
+        self.writer.queue(self, f"create label '{name}'", 'createLabel', input)
+
+    def get_issues(self, labels=GithubObject.NotSet, **kwargs):
+        if labels is not GithubObject.NotSet:
+            labels = [label._label if isinstance(label, _BatchedLabel) else label for label in labels]
+
+        for issue in self._repo.get_issues(labels=labels, **kwargs):
+            yield _BatchedIssue(issue, self)
+
+
+class _BatchedLabel:
+    def __init__(self, label: Label.Label, repo: _BatchedRepo):
+        self._label = label
+        self._repo = repo
+
+    def __getattr__(self, name):
+        return getattr(self._label, name)
+
+    def edit(self, name: str, color, description=GithubObject.NotSet):
+        input = {'id': _node_id(self._label), 'name': name}
+        if isinstance(color, str):
+            input['color'] = color
+        if isinstance(description, str):
+            input['description'] = description
+
+        self._repo.label_ids[name] = input['id']
+        self._repo.writer.queue(self._repo, f"edit label '{self._label.name}'", 'updateLabel', input)
+
+    def delete(self):
+        self._repo.writer.queue(self._repo, f"delete label '{self._label.name}'", 'deleteLabel', {
+            'id': _node_id(self._label),
+        })
+
+
+class _BatchedIssue:
+    def __init__(self, issue, repo: _BatchedRepo):
+        self._issue = issue
+        self._repo = repo
+
+    def __getattr__(self, name):
+        return getattr(self._issue, name)
+
+    def add_to_labels(self, *labels):
+        description = f"add labels to issue #{self._issue.number}"
+        label_ids = [self._repo.label_ids.get(label) for label in labels]
+        if None in label_ids:
+            self._repo.writer.queue(self._repo, description, fallback=lambda: self._issue.add_to_labels(*labels))
+            return
+
+        self._repo.writer.queue(self._repo, description, 'addLabelsToLabelable', {
+            'labelableId': _node_id(self._issue),
+            'labelIds': label_ids,
+        })
+
+
+class WorkQueue:
+    """
+    WorkQueue is a list of repos to process kept in a SQLite file, so that any number of workers can share it. Workers
+    lease one repo at a time and keep renewing the lease while they process it. A lease that is not renewed, such as
+    that of a dead worker, expires and the repo is handed out again, up to `max_attempts` times.
+    """
+
+    max_attempts = 3
+
+    def __init__(self, path: str, lease: int = 600):
+        self._path = path
+        self._lease = lease
+        db = sqlite3.connect(self._path)
+        try:
+            # Lets workers read while another one writes
+            db.execute("PRAGMA journal_mode=WAL")
+        finally:
+            db.close()
+
+        with self._connect() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS repos (
+                    name TEXT PRIMARY KEY,
+                    config TEXT NOT NULL,
+                    state TEXT NOT NULL,  -- pending, leased, done or failed
+                    worker TEXT,
+                    lease_until REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    output TEXT,
+                    error TEXT
+                )
+            """)
+
+    @contextmanager
+    def _connect(self):
+        """
+        Runs the statements in the block as a single write transaction, on a connection of its own. Connections cannot
+        be shared between threads, and leases are renewed from a thread of their own.
+        """
+        db = sqlite3.connect(self._path, timeout=60, isolation_level=None)
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        finally:
+            db.close()
+
+    def load(self, repos):
+        """
+        Queues repos given as (name, config) pairs, resetting any that were already in the queue.
+        """
+        rows = [(name, json.dumps(repoconfig)) for name, repoconfig in repos]
+        with self._connect() as db:
+            db.executemany("""
+                INSERT OR REPLACE INTO repos (name, config, state, attempts) VALUES (?, ?, 'pending', 0)
+            """, rows)
+        return len(rows)
+
+    def lease(self, worker: str):
+        """
+        Assigns the next available repo to the worker, returning its name and config, or None if there is none.
+        """
+        now = time.time()
+        with self._connect() as db:
+            db.execute("""
+                UPDATE repos SET state = 'failed', error = 'Lease expired too many times'
+                WHERE state = 'leased' AND lease_until < ? AND attempts >= ?
+            """, (now, self.max_attempts))
+            row = db.execute("""
+                SELECT name, config FROM repos
+                WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?)
+                ORDER BY attempts LIMIT 1
+            """, (now,)).fetchone()
+            if row is None:
+                return None
+
+            db.execute("""
+                UPDATE repos SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 WHERE name = ?
+            """, (worker, now + self._lease, row[0]))
+        return row[0], json.loads(row[1])
+
+    def renew(self, name: str, worker: str):
+        with self._connect() as db:
+            db.execute("""
+                UPDATE repos SET lease_until = ? WHERE name = ? AND worker = ? AND state = 'leased'
+            """, (time.time() + self._lease, name, worker))
+
+    def complete(self, name: str, worker: str, output: str, error: Exception = None):
+        # A worker whose lease expired and was handed to another one does not get to record its result
+        with self._connect() as db:
+            db.execute("""
+                UPDATE repos SET state = ?, output = ?, error = ?, lease_until = NULL
+                WHERE name = ? AND worker = ? AND state = 'leased'
+            """, ('failed' if error is not None else 'done', output, str(error) if error is not None else None,
+                  name, worker))
+
+    def counts(self):
+        with self._connect() as db:
+            return dict(db.execute("SELECT state, COUNT(*) FROM repos GROUP BY state").fetchall())
+
+    def leases(self, worker: str, poll: float = 5.0):
+        """
+        Yields repos leased to the worker, renewing each lease in the background until the next repo is requested.
+        When no repo is available but others are still leased, waits in case their leases expire, and returns once
+        every repo is done or failed.
+        """
+        while True:
+            leased = self.lease(worker)
+            if leased is None:
+                if not self.counts().get('leased'):
+                    return
+                time.sleep(poll)
+                continue
+
+            done = threading.Event()
+            renewal = threading.Thread(target=self._renew_until, args=(leased[0], worker, done), daemon=True)
+            renewal.start()
+            try:
+                yield leased
+            finally:
+                done.set()
+                renewal.join()
+
+    def _renew_until(self, name: str, worker: str, done: threading.Event):
+        while not done.wait(self._lease / 3):
+            self.renew(name, worker)
+
+
 if __name__ == '__main__':
     main()
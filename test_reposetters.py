@@ -1,6 +1,6 @@
 import unittest
-from unittest.mock import MagicMock, call
-from github import GithubObject
+from unittest.mock import MagicMock, call, patch
+from github import GithubObject, UnknownObjectException
 
 import reposettings as rs
 
@@ -257,6 +257,104 @@ class TestBranchProtectionHook(unittest.TestCase):
             dismiss_stale_reviews=True,
         )
 
+    def _protected_repo(self, org='txqueuelen'):
+        branchmock = MagicMock()
+        branchmock.name = 'main'
+        branchmock.protected = True
+
+        repomock = MagicMock()
+        repomock.organization.login = org
+        repomock.get_branches.return_value = [branchmock]
+        return repomock, branchmock
+
+    def _client(self, role='admin'):
+        authenticated = MagicMock()
+        authenticated.get_organization_membership.return_value.role = role
+
+        ghmock = MagicMock()
+        ghmock.get_user.side_effect = lambda login=None: authenticated if login is None else self._lookup(login, 'ghost')
+        return ghmock
+
+    def test_invalid_references(self):
+        ghmock = self._client()
+
+        repos = [self._protected_repo() for _ in range(3)]
+        for repomock, _ in repos:
+            repomock.organization.get_team_by_slug.side_effect = lambda slug: self._lookup(slug, 'gone')
+
+        config = {
+            "branch-protection": {
+                "push-restrictions": {
+                    "users": ["roobre", "ghost"],
+                    "teams": ["txqueuelen", "gone"],
+                },
+                "required-pull-request-reviews": {
+                    "dismissal-restrictions": {"users": ["ghost", "kang-makes"]},
+                },
+            },
+        }
+
+        with rs.RunMemo(ghmock).active():
+            for repomock, _ in repos:
+                rs.BranchProtectionHook.set(repomock, config)
+
+        for _, branchmock in repos:
+            branchmock.edit_protection.assert_called_once_with(
+                user_push_restrictions=['roobre'],
+                team_push_restrictions=['txqueuelen'],
+                dismissal_users=['kang-makes'],
+            )
+
+        # Each user and team is looked up once per run
+        users = [c.args[0] for c in ghmock.get_user.call_args_list if c.args]
+        self.assertCountEqual(users, ['roobre', 'ghost', 'kang-makes'])
+        self.assertEqual(sum(r.organization.get_team_by_slug.call_count for r, _ in repos), 2)
+
+    def test_hidden_teams_kept(self):
+        repomock, branchmock = self._protected_repo()
+        repomock.organization.get_team_by_slug.side_effect = lambda slug: self._lookup(slug, 'gone')
+
+        # Teams the token cannot see are not found either, unless it belongs to an org owner
+        with rs.RunMemo(self._client(role='member')).active():
+            rs.BranchProtectionHook.set(repomock, {"branch-protection": {"push-restrictions": {"teams": ["gone"]}}})
+
+        branchmock.edit_protection.assert_called_once_with(team_push_restrictions=['gone'])
+
+    def test_references_not_emptied(self):
+        repomock, branchmock = self._protected_repo()
+
+        # Pushing would be restricted to nobody
+        with rs.RunMemo(self._client()).active(), self.assertRaises(Exception):
+            rs.BranchProtectionHook.set(repomock, {"branch-protection": {"push-restrictions": {"users": ["ghost"]}}})
+
+        branchmock.edit_protection.assert_not_called()
+
+    @staticmethod
+    def _lookup(name, missing):
+        if name == missing:
+            raise UnknownObjectException(404, {"message": "Not Found"}, {})
+        return MagicMock()
+
+    def test_shared_rules_computed_once(self):
+        config = {"branch-protection": {"required-review-count": 2}}
+
+        with patch.object(rs.BranchProtectionHook, 'settings_for', wraps=rs.BranchProtectionHook.settings_for) as spy:
+            with rs.RunMemo().active():
+                for _ in range(5):
+                    repomock, branchmock = self._protected_repo()
+                    rs.BranchProtectionHook.set(repomock, dict(config))  # Equal, not the same, fragment
+                    branchmock.edit_protection.assert_called_once_with(required_approving_review_count=2)
+
+        spy.assert_called_once()
+
+    def test_no_lookups_without_client(self):
+        repomock, branchmock = self._protected_repo()
+        rs.BranchProtectionHook.set(repomock, {"branch-protection": {"push-restrictions": {"teams": ["gone"]}}})
+
+        repomock.organization.get_team_by_slug.assert_not_called()
+        branchmock.edit_protection.assert_called_once_with(team_push_restrictions=['gone'])
+
+
 class TestLabelHook(unittest.TestCase):
     def test_missing(self):
         lh = rs.LabelHook()
@@ -490,5 +588,177 @@ class TestLabelHook(unittest.TestCase):
         labels[1].edit.assert_not_called()
 
 
+class CallCounter:
+    """
+    Tracks mocked repos, branches, labels and issues, and counts calls to the PyGithub methods that hit the API on them.
+    Calls to methods not listed as writes count as reads, so that a new lookup such as `repo.get_label(name)` in a loop
+    is caught without listing it first.
+    """
+
+    writes = ('edit', 'edit_protection', 'create_label', 'delete', 'add_to_labels')
+
+    def __init__(self):
+        self.mocks = []
+
+    def track(self, mock):
+        self.mocks.append(mock)
+        return mock
+
+    def calls(self):
+        """
+        Returns the number of reads and writes made on tracked mocks.
+        """
+        reads = writes = 0
+        for mock in self.mocks:
+            # mock_calls also has calls on children, named after the path to them, such as `get_protection().edit`
+            for name, _, _ in mock.mock_calls:
+                method = name.rsplit('.', 1)[-1]
+                if method.startswith('__'):  # Python protocols, such as iterating, do not hit the API
+                    continue
+                if method in self.writes:
+                    writes += 1
+                else:
+                    reads += 1
+        return reads, writes
+
+    def repo(self, branches=(), labels=(), issues=()):
+        repomock = self.track(MagicMock())
+        repomock.default_branch = 'main'
+        repomock.get_branches.return_value = list(branches)
+        repomock.get_labels.return_value = list(labels)
+        repomock.get_issues.return_value = list(issues)
+        return repomock
+
+    def branch(self, name, protected):
+        branchmock = self.track(MagicMock())
+        branchmock.name = name
+        branchmock.protected = protected
+        return branchmock
+
+    def label(self, name, color='aabbcc', description='Description'):
+        labelmock = self.track(MagicMock())
+        labelmock.name = name
+        labelmock.color = color
+        labelmock.description = description
+        return labelmock
+
+    def issue(self):
+        return self.track(MagicMock())
+
+
+class TestCallBudgets(unittest.TestCase):
+    """
+    Each scenario sets the most API calls setters may make on it, so changes adding calls to hot paths fail here.
+    """
+
+    def setUp(self):
+        self.counter = CallCounter()
+
+    def assertBudget(self, reads, writes):
+        made_reads, made_writes = self.counter.calls()
+        self.assertLessEqual(made_reads, reads, "read budget exceeded")
+        self.assertLessEqual(made_writes, writes, "write budget exceeded")
+
+    def test_repo_unchanged(self):
+        repomock = self.counter.repo()
+        repomock.has_issues = True
+        repomock.allow_squash_merge = False
+
+        rs.RepoHook.set(repomock, {
+            "features": {"issues": True},
+            "allow": {"squash-merge": False},
+        })
+
+        self.assertBudget(reads=0, writes=0)
+
+    def test_repo_changed(self):
+        repomock = self.counter.repo()
+        repomock.has_issues = False
+        repomock.has_wiki = False
+
+        rs.RepoHook.set(repomock, {
+            "features": {"issues": True, "wiki": True},
+        })
+
+        self.assertBudget(reads=0, writes=1)
+
+    def test_many_branches(self):
+        branches = [self.counter.branch(f"branch{i}", protected=i % 100 == 0) for i in range(1000)]
+        repomock = self.counter.repo(branches=branches)
+
+        rs.BranchProtectionHook.set(repomock, {
+            "branch-protection": {"required-review-count": 2},
+        })
+
+        # One listing, and the protection of each of the 10 protected branches read and written
+        self.assertBudget(reads=1 + 10, writes=10)
+
+    def test_protect_default_branch(self):
+        branches = [self.counter.branch('main', protected=False)]
+        branches += [self.counter.branch(f"branch{i}", protected=False) for i in range(1000)]
+        repomock = self.counter.repo(branches=branches)
+
+        rs.BranchProtectionHook.set(repomock, {
+            "branch-protection": {"required-review-count": 2},
+            "protect-default-branch": True,
+        })
+
+        # Unprotected branches have no protection to read
+        self.assertBudget(reads=1, writes=1)
+
+    def test_many_labels_unchanged(self):
+        labels = [self.counter.label(f"label{i}") for i in range(500)]
+        repomock = self.counter.repo(labels=labels)
+
+        rs.LabelHook.set(repomock, {
+            "labels": {f"label{i}": {"color": "aabbcc", "description": "Description"} for i in range(500)},
+        })
+
+        self.assertBudget(reads=1, writes=0)
+
+    def test_many_labels_replaced(self):
+        labels = [self.counter.label(f"old{i}") for i in range(500)]
+        repomock = self.counter.repo(labels=labels)
+
+        rs.LabelHook.set(repomock, {
+            "labels": {f"new{i}": {"color": "112233", "replaces": [f"old{i}"]} for i in range(500)},
+        })
+
+        self.assertBudget(reads=1, writes=500)
+
+    def test_many_labels_created_and_deleted(self):
+        labels = [self.counter.label(f"old{i}") for i in range(500)]
+        repomock = self.counter.repo(labels=labels)
+
+        rs.LabelHook.set(repomock, {
+            "labels": {f"new{i}": {"color": "112233"} for i in range(500)},
+        })
+
+        self.assertBudget(reads=1, writes=500 + 500)
+
+    def test_labels_replaced_by_existent(self):
+        labels = [self.counter.label("new")] + [self.counter.label(f"old{i}") for i in range(100)]
+        issues = [self.counter.issue() for _ in range(5)]
+        repomock = self.counter.repo(labels=labels, issues=issues)
+
+        rs.LabelHook.set(repomock, {
+            "labels": {"new": {"replaces": [f"old{i}" for i in range(100)]}},
+        })
+
+        # Issues are listed once per replaced label, then relabelled, then the replaced label is deleted
+        self.assertBudget(reads=1 + 100, writes=100 * len(issues) + 100)
+
+    def test_unlisted_calls_are_reads(self):
+        labels = [self.counter.label(f"label{i}") for i in range(3)]
+        repomock = self.counter.repo(labels=labels)
+
+        # A lookup per label, as a setter fetching each label again would make
+        for label in repomock.get_labels():
+            repomock.get_label(label.name)
+        list(iter(repomock))
+
+        self.assertEqual(self.counter.calls(), (1 + 3, 0))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,11 @@
+import io
+import os
+import tempfile
+import threading
+import time
 import unittest
-from unittest.mock import MagicMock
+from contextlib import redirect_stdout
+from unittest.mock import MagicMock, patch
 
 import reposettings as rs
 
@@ -23,6 +29,7 @@ class TestRepoSettings(unittest.TestCase):
     def test_apply(self):
         ghmock = MagicMock()
         r = rs.RepoSettings(ghmock)
+        self.addCleanup(r.close)
         r.apply({
             "repos": {
                 "test": {}
@@ -40,6 +47,711 @@ class TestRepoSettings(unittest.TestCase):
         })
         settermock.set.assert_called_once()
 
+    def test_apply_concurrent(self):
+        started = threading.Barrier(2, timeout=5)
+        finished = []
+
+        class First(rs.RepoSetter):
+            @staticmethod
+            def set(repo, config):
+                started.wait()  # Deadlocks unless Second runs at the same time
+                print(" first")
+                finished.append("first")
+
+        class Second(rs.RepoSetter):
+            @staticmethod
+            def set(repo, config):
+                started.wait()
+                print(" second")
+                finished.append("second")
+
+        class Last(rs.RepoSetter):
+            @staticmethod
+            def depends_on():
+                return First, Second
+
+            @staticmethod
+            def set(repo, config):
+                self.assertCountEqual(finished, ["first", "second"])
+                finished.append("last")
+
+        r = rs.RepoSettings(MagicMock())
+        self.addCleanup(r.close)
+        r.use(Last())
+        r.use(First())
+        r.use(Second())
+        r.apply({
+            "repos": {
+                "test": {}
+            }
+        })
+
+        self.assertEqual(finished[-1], "last")
+
+    def test_builtin_stages(self):
+        stages = [[type(setter) for setter in stage] for stage in rs.repo_settings(MagicMock(), None)._stages()]
+        self.assertEqual(stages, [[rs.RepoHook, rs.BranchProtectionHook], [rs.LabelHook]])
+
+    def test_apply_circular(self):
+        class Loop(rs.RepoSetter):
+            @staticmethod
+            def depends_on():
+                return Loop,
+
+        r = rs.RepoSettings(MagicMock())
+        self.addCleanup(r.close)
+        r.use(Loop())
+        r.use(Loop())
+        with self.assertRaises(Exception):
+            r.apply({
+                "repos": {
+                    "test": {}
+                }
+            })
+
+    def test_apply_workers(self):
+        ghmock = MagicMock()
+        r = rs.RepoSettings(ghmock, workers=4)
+        self.addCleanup(r.close)
+        settermock = MagicMock()
+        settermock.name.return_value = "mock"
+        r.use(settermock)
+        r.apply({
+            "repos": {f"org/repo{i}": {} for i in range(10)}
+        })
+
+        self.assertEqual(settermock.set.call_count, 10)
+        self.assertCountEqual([c.args[0] for c in ghmock.get_repo.call_args_list], [f"org/repo{i}" for i in range(10)])
+
+    def test_apply_workers_output_order(self):
+        settermock = MagicMock()
+        settermock.name.return_value = "mock"
+        # Later repos finish first
+        settermock.set.side_effect = lambda repo, config: (time.sleep(0.01 * (9 - config['i'])), print(config['i']))
+
+        r = rs.RepoSettings(MagicMock(), workers=4)
+        self.addCleanup(r.close)
+        r.use(settermock)
+        with redirect_stdout(io.StringIO()) as out:
+            r.apply({
+                "repos": {f"org/repo{i}": {"i": i} for i in range(10)}
+            })
+
+        printed = [int(line) for line in out.getvalue().split() if line.isdigit()]
+        self.assertEqual(printed, list(range(10)))
+
+    def test_apply_error(self):
+        settermock = MagicMock()
+        settermock.name.return_value = "mock"
+        settermock.set.side_effect = Exception("failed")
+
+        r = rs.RepoSettings(MagicMock(), workers=1)
+        self.addCleanup(r.close)
+        r.use(settermock)
+        with self.assertRaises(Exception):
+            r.apply({
+                "repos": {f"org/repo{i}": {} for i in range(10)}
+            })
+
+        # Repos after the failed one are not started
+        settermock.set.assert_called_once()
+
+    def test_close(self):
+        settermock = MagicMock()
+        settermock.name.return_value = "mock"
+
+        with rs.RepoSettings(MagicMock(), workers=4) as r:
+            r.use(settermock)
+            r.apply({"repos": {f"org/repo{i}": {} for i in range(10)}})
+            threads = list(r._setter_pool._threads)
+
+        self.assertTrue(threads)
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+
+    def test_apply_repo(self):
+        settermock = MagicMock()
+        settermock.name.return_value = "mock"
+        settermock.set.side_effect = lambda repo, config: print(" setting")
+
+        r = rs.RepoSettings(MagicMock())
+        self.addCleanup(r.close)
+        r.use(settermock)
+        output, error = r.apply_repo("org/repo", {})
+
+        self.assertIsNone(error)
+        self.assertIn("Using setter 'mock'\n setting\n", output)
+
+        settermock.set.side_effect = Exception("failed")
+        output, error = r.apply_repo("org/repo", {})
+        self.assertEqual(str(error), "failed")
+
+
+class TestAdaptiveLimit(unittest.TestCase):
+    def test_increase(self):
+        limit = rs.AdaptiveLimit("test", initial=2, maximum=4)
+        for _ in range(100):
+            limit.observe(0.1, throttled=False)
+
+        self.assertEqual(limit.limit, 4)
+
+    def test_decrease(self):
+        limit = rs.AdaptiveLimit("test", initial=16, maximum=32, cooldown=0)
+        limit.observe(0.1, throttled=True)
+        self.assertEqual(limit.limit, 8)
+
+        limit.observe(0.1, throttled=False)
+        limit.observe(10, throttled=False)  # Latency spike
+        self.assertLess(limit.limit, 5)
+
+        for _ in range(10):
+            limit.observe(0.1, throttled=True)
+        self.assertEqual(limit.limit, 1)
+
+    def test_cooldown(self):
+        limit = rs.AdaptiveLimit("test", initial=16, maximum=32, cooldown=60)
+        for _ in range(5):
+            limit.observe(0.1, throttled=True)
+
+        self.assertEqual(limit.limit, 8)
+
+    def test_in_flight(self):
+        limit = rs.AdaptiveLimit("test", initial=2, maximum=2)
+        limit.acquire()
+        limit.acquire()
+
+        acquired = threading.Event()
+
+        def third():
+            limit.acquire()
+            acquired.set()
+
+        threading.Thread(target=third, daemon=True).start()
+        self.assertFalse(acquired.wait(0.1))
+        limit.release()
+        self.assertTrue(acquired.wait(5))
+
+
+class TestThrottle(unittest.TestCase):
+    def test_throttled(self):
+        self.assertTrue(rs.Throttle.throttled(429, ''))
+        self.assertTrue(rs.Throttle.throttled(403, '{"message": "You have exceeded a secondary rate limit."}'))
+        self.assertFalse(rs.Throttle.throttled(403, '{"message": "Resource not accessible by integration"}'))
+        self.assertFalse(rs.Throttle.throttled(200, '{}'))
+
+    def test_request(self):
+        throttle = rs.Throttle()
+        response = throttle._request(lambda: (429, {}, ''), 'PATCH', '/repos/org/repo')
+
+        self.assertEqual(response, (429, {}, ''))
+        self.assertEqual(throttle.writes.limit, 1)
+        self.assertEqual(throttle.reads.limit, 4)
+
+    def test_client(self):
+        throttle = rs.Throttle()
+        with patch.dict(os.environ, {'GITHUB_TOKEN': 'token'}):
+            gh = rs.github_client(rs.Profiler(enabled=False), throttle)
+
+        # Only the throttle paces requests, and every request it lets through has a connection
+        requester = gh._Github__requester
+        self.assertIsNone(requester._Requester__seconds_between_requests)
+        self.assertIsNone(requester._Requester__seconds_between_writes)
+        self.assertEqual(requester._Requester__pool_size, throttle.reads.maximum + throttle.writes.maximum)
+
+
+class TestRunMemo(unittest.TestCase):
+    def test_get_once(self):
+        memo = rs.RunMemo()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return "value"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(memo.get("key", compute))) for _ in range(4)]
+        for t in threads:
+            t.start()
+        started.wait(5)
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, ["value"] * 4)
+
+    def test_key(self):
+        self.assertEqual(rs.RunMemo.key({"b": [1], "a": {"c": True}}), rs.RunMemo.key({"a": {"c": True}, "b": [1]}))
+
+    def test_shared_by_run(self):
+        seen = []
+
+        class Setter(rs.RepoSetter):
+            @staticmethod
+            def set(repo, config):
+                seen.append(rs.RunMemo.current())
+
+        memo = rs.RunMemo()
+        r = rs.RepoSettings(MagicMock(), workers=4, memo=memo)
+        self.addCleanup(r.close)
+        r.use(Setter())
+        r.apply({
+            "repos": {f"org/repo{i}": {} for i in range(10)}
+        })
+
+        self.assertEqual(seen, [memo] * 10)
+        self.assertIsNot(rs.RunMemo.current(), memo)
+
+
+class TestProfiler(unittest.TestCase):
+    def test_spans(self):
+        p = rs.Profiler()
+        r = rs.RepoSettings(MagicMock(), p)
+        self.addCleanup(r.close)
+        settermock = MagicMock()
+        settermock.name.return_value = "mock"
+        r.use(settermock)
+
+        with p.span("apply"):
+            r.apply({
+                "repos": {
+                    "org/one": {},
+                    "org/two": {},
+                }
+            })
+
+        stacks = [line.rsplit(' ', 1)[0] for line in p.collapsed()]
+        self.assertIn("apply;repo:org/one;setter:mock", stacks)
+        self.assertIn("apply;repo:org/two;setter:mock", stacks)
+
+        phases = [line.split()[0] for line in p.summary()[1:]]
+        self.assertEqual(phases, ["apply", "repo:*", "setter:mock"])
+
+    def test_cpu_profile_per_thread(self):
+        p = rs.Profiler()
+        r = rs.RepoSettings(MagicMock(), p, workers=2)
+        self.addCleanup(r.close)
+        for name in ("one", "two"):
+            settermock = MagicMock()
+            settermock.name.return_value = name
+            r.use(settermock)
+
+        r.apply({"repos": {f"org/repo{i}": {} for i in range(10)}})
+
+        # Main thread aside, at most one profile for each repo worker and each shared setter thread
+        self.assertLessEqual(len(p._profiles), 1 + 2 + 2 * 2)
+
+    def test_disabled(self):
+        p = rs.Profiler(enabled=False)
+        with p.span("apply"):
+            pass
+
+        self.assertEqual([line.rsplit(' ', 1)[0] for line in p.collapsed()], ["other"])
+
+
+class TestSnapshot(unittest.TestCase):
+    def test_capture(self):
+        protected = MagicMock()
+        protected.name = 'main'
+        protected.protected = True
+        protected.get_protection.return_value.enforce_admins = True
+        protected.get_protection.return_value.required_linear_history = False
+
+        unprotected = MagicMock()
+        unprotected.name = 'feature'
+        unprotected.protected = False
+
+        label = MagicMock()
+        label.name = 'bug'
+        label.color = 'ff0000'
+        label.description = None
+
+        repomock = MagicMock()
+        repomock.full_name = 'org/repo'
+        repomock.name = 'repo'
+        for setting in rs.RepoState.settings:
+            setattr(repomock, setting, None)
+        repomock.has_issues = True
+        repomock.allow_squash_merge = False
+        repomock.default_branch = 'main'
+        repomock.delete_branch_on_merge = True
+        repomock.open_issues_count = 3
+        repomock.get_branches.return_value = [protected, unprotected]
+        repomock.get_labels.return_value = [label]
+
+        ghmock = MagicMock()
+        ghmock.get_repo.return_value = repomock
+
+        with redirect_stdout(io.StringIO()):
+            snap = rs.Snapshot.capture(ghmock, ['org/repo'])
+        unprotected.get_protection.assert_not_called()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'snapshot.json.gz')
+            snap.save(path)
+            repo = rs.Snapshot.load(path).get_repo('org/repo')
+
+        self.assertEqual(repo.full_name, 'org/repo')
+        self.assertTrue(repo.has_issues)
+        self.assertFalse(repo.allow_squash_merge)
+        self.assertFalse(hasattr(repo, 'has_wiki'))
+        self.assertFalse(hasattr(repo, '__dict__'))
+        self.assertEqual([b.name for b in repo.get_branches()], ['main', 'feature'])
+        self.assertTrue(repo.get_branches()[0].get_protection().enforce_admins)
+        self.assertEqual([(l.name, l.color) for l in repo.get_labels()], [('bug', 'ff0000')])
+
+    def test_plan(self):
+        snap = rs.Snapshot({
+            "org/repo": rs.RepoState.load("org/repo", {
+                "name": "repo",
+                "default_branch": "main",
+                "open_issues_count": 0,
+                "settings": {"has_issues": False, "has_wiki": True},
+                "branches": [
+                    ["main", True, {"enforce_admins": False}],
+                    ["feature", False, None],
+                ],
+                "labels": [
+                    ["bug", "ff0000", None],
+                    ["old", "00ff00", None],
+                ],
+            }),
+        })
+
+        out = io.StringIO()
+        with redirect_stdout(out), rs.repo_settings(snap, None) as r:
+            r.apply({
+                "repos": {
+                    "https://github.com/org/repo": {
+                        "features": {"issues": True, "wiki": True},
+                        "branch-protection": {"enforce-admins": True},
+                        "labels": {"bug": {"color": "ff0000"}, "feature": {"color": "0000ff"}},
+                    },
+                },
+            })
+
+        plan = [line.strip() for line in out.getvalue().splitlines() if line.startswith(" Plan: ")]
+        self.assertEqual(plan, [
+            "Plan: edit repo settings: has_issues=True, has_wiki=True",
+            "Plan: edit protection of branch 'main': enforce_admins=True",
+            "Plan: delete label 'old'",
+            "Plan: create label 'feature': color='0000ff'",
+        ])
+
+    def test_missing_repo(self):
+        with self.assertRaises(Exception):
+            rs.Snapshot({}).get_repo('org/repo')
+
+
+class TestEstimate(unittest.TestCase):
+    def test_snapshot(self):
+        snap = rs.Snapshot({
+            "org/repo": rs.RepoState.load("org/repo", {
+                "name": "repo",
+                "default_branch": "main",
+                "open_issues_count": 45,
+                "settings": {"has_issues": True},
+                "branches": [["main", True, {}]] + [[f"branch{i}", False, None] for i in range(70)],
+                "labels": [["old", "ff0000", None], ["new", "00ff00", None]],
+            }),
+        })
+
+        calls = rs.Estimate(snap, per_page=30)
+        with redirect_stdout(io.StringIO()), rs.repo_settings(calls, None) as r:
+            r.apply({
+                "repos": {
+                    "org/repo": {
+                        "features": {"issues": True},
+                        "branch-protection": {"enforce-admins": True},
+                        "labels": {"new": {"color": "00ff00", "replaces": ["old"]}},
+                    },
+                },
+            })
+
+        self.assertEqual(calls.calls, {
+            ("org/repo", None): [1, 0],
+            # 3 pages of branches and the protection of main, which is then edited
+            ("org/repo", rs.BranchProtectionHook.name()): [4, 1],
+            # A page of labels and 2 of issues, 45 issues relabelled and the old label deleted
+            ("org/repo", rs.LabelHook.name()): [3, 46],
+        })
+        self.assertEqual(calls.totals(), (8, 47))
+
+    def test_assumed(self):
+        calls = rs.Estimate()
+        with redirect_stdout(io.StringIO()), rs.repo_settings(calls, None) as r:
+            r.apply({
+                "repos": {
+                    f"org/repo{i}": {
+                        "features": {"issues": True},
+                        "branch-protection": {"enforce-admins": True},
+                        "labels": {"bug": {"color": "ff0000"}, "feature": {"color": "00ff00"}},
+                    } for i in range(10)
+                },
+            })
+
+        # Read repo, branches, protection and labels. Edit repo and protection, create both labels.
+        self.assertEqual(calls.totals(), (40, 40))
+        self.assertEqual(calls.report()[-1].split()[1:], ["40", "40"])
+
+    def test_lookups(self):
+        calls = rs.Estimate()
+        with redirect_stdout(io.StringIO()), rs.repo_settings(calls, None, memo=rs.RunMemo(calls)) as r:
+            r.apply({
+                "repos": {
+                    f"org/repo{i}": {
+                        "branch-protection": {"push-restrictions": {"users": ["roobre"], "teams": ["a", "b"]}},
+                    } for i in range(10)
+                },
+            })
+
+        # Read repo, branches and protection, edit protection, plus the user and both teams once per run
+        self.assertEqual(calls.totals(), (30 + 3, 10))
+
+    def test_assumed_labels(self):
+        config = {
+            "repos": {
+                "org/repo": {"labels": {"new": {"color": "00ff00", "replaces": ["old"]}}},
+            },
+        }
+        calls = rs.Estimate(config=config, labels=3, open_issues=45)
+        with redirect_stdout(io.StringIO()):
+            r = rs.RepoSettings(calls)
+            self.addCleanup(r.close)
+            r.use(rs.LabelHook)
+            r.apply(config)
+
+        self.assertEqual(calls.assumed_labels("org/repo"), ["new", "old", "unknown label 0"])
+        # A page of labels and 2 of issues. New edited, 45 issues relabelled, old and the unknown label deleted.
+        self.assertEqual(calls.calls[("org/repo", rs.LabelHook.name())], [3, 48])
+
+
+class TestBatchWriter(unittest.TestCase):
+    def _label(self, name, node_id):
+        label = MagicMock()
+        label.name = name
+        label.color = "aabbcc"
+        label.description = None
+        label._rawData = {"node_id": node_id}
+        return label
+
+    def test_labels(self):
+        old = self._label("old", "L_old")
+        replaced = self._label("replaced", "L_replaced")
+        issue = MagicMock()
+        issue.number = 1
+        issue._rawData = {"node_id": "I_1"}
+
+        repomock = MagicMock()
+        repomock.full_name = "org/repo"
+        repomock._rawData = {"node_id": "R_1"}
+        repomock.get_labels.return_value = [old, replaced]
+        repomock.get_issues.return_value = [issue]
+
+        ghmock = MagicMock()
+        ghmock.get_repo.return_value = repomock
+        requester = ghmock._Github__requester
+        requester.requestJsonAndCheck.return_value = ({}, {
+            "data": {},
+            "errors": [{"path": ["w3"], "message": "boom"}],
+        })
+
+        writer = rs.BatchWriter(ghmock)
+        with redirect_stdout(io.StringIO()) as out:
+            rs.LabelHook.set(writer.get_repo("org/repo"), {
+                "labels": {
+                    "new": {"color": "111111", "replaces": ["old", "replaced"]},
+                    "created": {"color": "222222", "description": "Created"},
+                },
+            })
+            writer.flush()
+
+        # Nothing is written through the REST API
+        old.edit.assert_not_called()
+        replaced.delete.assert_not_called()
+        issue.add_to_labels.assert_not_called()
+        repomock.create_label.assert_not_called()
+        repomock.get_issues.assert_called_once_with(labels=[replaced])
+
+        requester.requestJsonAndCheck.assert_called_once()
+        body = requester.requestJsonAndCheck.call_args.kwargs["input"]
+        self.assertIn("w0: updateLabel(input: $w0)", body["query"])
+        self.assertIn("$w3: CreateLabelInput!", body["query"])
+        self.assertEqual(body["variables"], {
+            "w0": {"id": "L_old", "name": "new", "color": "111111"},
+            "w1": {"labelableId": "I_1", "labelIds": ["L_old"]},
+            "w2": {"id": "L_replaced"},
+            "w3": {"repositoryId": "R_1", "name": "created", "color": "222222", "description": "Created"},
+        })
+
+        self.assertEqual(writer.failed, 1)
+        self.assertIn("Error in 'org/repo' (None) trying to create label 'created': boom", out.getvalue())
+
+    def test_batch_size(self):
+        repomock = MagicMock()
+        repomock._rawData = {"node_id": "R_1"}
+        repomock.get_labels.return_value = []
+
+        ghmock = MagicMock()
+        ghmock.get_repo.return_value = repomock
+        ghmock._Github__requester.requestJsonAndCheck.return_value = ({}, {"data": {}})
+
+        writer = rs.BatchWriter(ghmock, batch_size=2)
+        with redirect_stdout(io.StringIO()):
+            rs.LabelHook.set(writer.get_repo("org/repo"), {
+                "labels": {f"label {i}": {"color": "111111"} for i in range(5)},
+            })
+            writer.flush()
+
+        self.assertEqual(writer.requests, 3)
+
+    def test_rejected(self):
+        repomock = MagicMock()
+        repomock.full_name = "org/repo"
+        repomock._rawData = {"node_id": "R_1"}
+        repomock.get_labels.return_value = []
+
+        ghmock = MagicMock()
+        ghmock.get_repo.return_value = repomock
+        ghmock._Github__requester.requestJsonAndCheck.return_value = ({}, {
+            "data": None,
+            "errors": [{"message": "Variable $w0 is invalid"}],
+        })
+
+        writer = rs.BatchWriter(ghmock)
+        with redirect_stdout(io.StringIO()) as out:
+            rs.LabelHook.set(writer.get_repo("org/repo"), {
+                "labels": {"one": {"color": "111111"}, "two": {"color": "222222"}},
+            })
+            writer.flush()
+
+        self.assertEqual(writer.failed, 2)
+        self.assertIn("trying to create label 'two': Variable $w0 is invalid", out.getvalue())
+
+    def test_repo_edit(self):
+        repomock = MagicMock()
+        repomock._rawData = {"node_id": "R_1"}
+        repomock.has_wiki = False
+        repomock.allow_merge_commit = False
+
+        ghmock = MagicMock()
+        ghmock.get_repo.return_value = repomock
+        ghmock._Github__requester.requestJsonAndCheck.return_value = ({}, {"data": {}})
+
+        writer = rs.BatchWriter(ghmock)
+        repo = writer.get_repo("org/repo")
+        with redirect_stdout(io.StringIO()):
+            rs.RepoHook.set(repo, {"features": {"wiki": True}})
+            repomock.edit.assert_not_called()
+
+            # Merge settings have no GraphQL mutation
+            rs.RepoHook.set(repo, {"allow": {"merge-commit": True}})
+            repomock.edit.assert_called_once_with(allow_merge_commit=True)
+
+            writer.flush()
+
+        body = ghmock._Github__requester.requestJsonAndCheck.call_args.kwargs["input"]
+        self.assertEqual(body["variables"], {"w0": {"hasWikiEnabled": True, "repositoryId": "R_1"}})
+
+    def test_issues_enabled_before_relabelling(self):
+        repomock = MagicMock()
+        repomock._rawData = {"node_id": "R_1"}
+        repomock.has_issues = False
+        repomock.get_labels.return_value = [self._label("new", "L_new"), self._label("old", "L_old")]
+        repomock.get_issues.return_value = []
+
+        ghmock = MagicMock()
+        ghmock.get_repo.return_value = repomock
+        ghmock._Github__requester.requestJsonAndCheck.return_value = ({}, {"data": {}})
+
+        r = rs.RepoSettings(rs.BatchWriter(ghmock))
+        self.addCleanup(r.close)
+        r.use(rs.RepoHook())
+        r.use(rs.LabelHook())
+        with redirect_stdout(io.StringIO()):
+            r.apply({
+                "repos": {
+                    "org/repo": {
+                        "features": {"issues": True},
+                        "labels": {"new": {"color": "aabbcc", "replaces": ["old"]}},
+                    },
+                },
+            })
+
+        # Issues are enabled through the REST API before LabelHook lists them
+        calls = [name for name, _, _ in repomock.mock_calls]
+        self.assertLess(calls.index('edit'), calls.index('get_issues'))
+        repomock.edit.assert_called_once_with(has_issues=True)
+
+
+class TestWorkQueue(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'queue.sqlite')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_lease(self):
+        queue = rs.WorkQueue(self.path)
+        self.assertEqual(queue.load([("org/one", {"a": 1}), ("org/two", {})]), 2)
+
+        first = queue.lease("worker1")
+        second = queue.lease("worker2")
+        self.assertCountEqual([first, second], [("org/one", {"a": 1}), ("org/two", {})])
+        self.assertIsNone(queue.lease("worker3"))
+
+        queue.complete(first[0], "worker1", "output")
+        queue.complete(second[0], "worker2", "", Exception("failed"))
+        self.assertEqual(queue.counts(), {"done": 1, "failed": 1})
+
+    def test_expired(self):
+        queue = rs.WorkQueue(self.path, lease=0)
+        queue.load([("org/one", {})])
+
+        self.assertEqual(queue.lease("dead")[0], "org/one")
+        time.sleep(0.01)
+        self.assertEqual(queue.lease("alive")[0], "org/one")
+
+        # The worker that lost the lease cannot record a result anymore
+        queue.complete("org/one", "dead", "", Exception("late"))
+        self.assertEqual(queue.counts(), {"leased": 1})
+        queue.complete("org/one", "alive", "")
+        self.assertEqual(queue.counts(), {"done": 1})
+
+    def test_max_attempts(self):
+        queue = rs.WorkQueue(self.path, lease=0)
+        queue.load([("org/one", {})])
+
+        for _ in range(rs.WorkQueue.max_attempts):
+            self.assertIsNotNone(queue.lease("dead"))
+            time.sleep(0.01)
+
+        self.assertIsNone(queue.lease("alive"))
+        self.assertEqual(queue.counts(), {"failed": 1})
+
+    def test_workers(self):
+        rs.WorkQueue(self.path).load((f"org/repo{i}", {}) for i in range(20))
+        processed = []
+
+        def worker(name):
+            queue = rs.WorkQueue(self.path)
+            for repo, repoconfig in queue.leases(name, poll=0.01):
+                processed.append(repo)
+                queue.complete(repo, name, "")
+
+        workers = [threading.Thread(target=worker, args=(f"worker{i}",)) for i in range(4)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+        self.assertCountEqual(processed, [f"org/repo{i}" for i in range(20)])
+        self.assertEqual(rs.WorkQueue(self.path).counts(), {"done": 20})
+
 
 if __name__ == '__main__':
     unittest.main()